@@ -4,10 +4,20 @@ from flask import Flask, jsonify
 from flask_restful import Api
 from flask_jwt import JWT, JWTError
 
-from security import authenticate, identity
-from resources.item import Item, ItemList
-from resources.store import Store, StoreList
-from resources.user import UserRegister
+from cache import RedisCache, response_cache
+from db import engine_options
+from profiling import profiler
+from security import authenticate, identity, init_revocations, jwt_payload
+from resources.item import Item, ItemList, ItemExport
+from resources.store import Store, StoreItems, StoreList, StoreSummary, StoreSummaryList
+from resources.user import UserRegister, UserLogout
+from resources.change import ChangeList
+from resources.metrics import Metrics, PoolStats, ProfileStats
+from metrics import request_metrics
+from committer import committer
+from replicas import replica_router
+from ratelimit import SharedBuckets, parse_limit, parse_limits, rate_limiter
+from compression import compressor
 
 app = Flask(__name__)
 
@@ -15,17 +25,62 @@ app.config['DEBUG'] = True
 
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///data.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], os.environ) # DB_POOL_* variables
+app.config['PROFILE_REQUESTS'] = os.environ.get('PROFILE_REQUESTS', '').lower() in ('1', 'true', 'yes') # Server-Timing and /metrics/profile
+app.config['SLOW_QUERY_SECONDS'] = float(os.environ['SLOW_QUERY_SECONDS']) if 'SLOW_QUERY_SECONDS' in os.environ else None
+app.config['METRICS_MULTIPROC_DIR'] = os.environ.get('METRICS_MULTIPROC_DIR') # shared by the worker processes, see metrics.RequestMetrics
+app.config['GROUP_COMMIT_WINDOW'] = float(os.environ.get('GROUP_COMMIT_WINDOW', 0)) # seconds, 0 commits every write on its own
+app.config['GROUP_COMMIT_MAX_BATCH'] = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 100))
+app.config['REPLICA_DATABASE_URIS'] = [uri for uri in os.environ.get('REPLICA_DATABASE_URLS', '').split(',') if uri] # read-only requests go there
+app.config['REPLICA_SELECTION'] = os.environ.get('REPLICA_SELECTION', 'round_robin') # or least_loaded
+app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 5)) # reads of a client after its writes stay on the primary
+app.config['REPLICA_RETRY_SECONDS'] = float(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+app.config['RATE_LIMITS'] = parse_limits(os.environ.get('RATE_LIMITS', '')) # {'METHOD endpoint': (requests per second, burst)}
+app.config['RATE_LIMIT_DEFAULT'] = parse_limit(os.environ['RATE_LIMIT_DEFAULT']) if 'RATE_LIMIT_DEFAULT' in os.environ else None
+app.config['MAX_CONCURRENT_REQUESTS'] = int(os.environ['MAX_CONCURRENT_REQUESTS']) if 'MAX_CONCURRENT_REQUESTS' in os.environ else None # e.g. DB_POOL_SIZE + DB_MAX_OVERFLOW
+app.config['COMPRESS_RESPONSES'] = os.environ.get('COMPRESS_RESPONSES', 'true').lower() in ('1', 'true', 'yes') # off when a proxy compresses
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024)) # bytes
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6)) # gzip, 1 (fastest) to 9 (smallest)
+app.config['JWT_AUTH_URL_OPTIONS'] = {'methods': ['POST'], 'endpoint': 'auth'} # 'POST auth' in RATE_LIMITS, Flask-JWT's view name otherwise
+app.config['JWT_LAZY_IDENTITY'] = os.environ.get('JWT_LAZY_IDENTITY', '').lower() in ('1', 'true', 'yes') # users are loaded when current_identity is used
+app.config['REVOKED_TOKENS_REDIS_URL'] = os.environ.get('REVOKED_TOKENS_REDIS_URL') # revocations shared by the workers, per process otherwise
 app.secret_key = 'jose123' # the secret key is used to encode cookies(we're not use this, it's recommended)
 api = Api(app)
+api.representation('application/json')(profiler.serialize)
+profiler.init_app(app) # X-Query-Count header on every response
+request_metrics.init_app(app) # /metrics
+committer.init_app(app) # group commit, see GROUP_COMMIT_WINDOW
+replica_router.init_app(app) # read replicas, see REPLICA_DATABASE_URIS
+rate_limiter.init_app(app) # 429/503 with Retry-After, after the hooks above so rejected requests are measured too
+compressor.init_app(app) # gzip/br, last so it runs first and the timings above include it
+
+if os.environ.get('RESPONSE_CACHE_REDIS_URL'): # share cached responses between workers, in-process LRU otherwise
+    import redis
+    response_cache.backend = RedisCache(redis.Redis.from_url(os.environ['RESPONSE_CACHE_REDIS_URL']),
+                                        ttl=float(os.environ.get('RESPONSE_CACHE_TTL', 300)))
+
+if os.environ.get('RATE_LIMIT_SHARED_FILE'): # token buckets shared by the workers of this machine, per process otherwise
+    rate_limiter.backend = SharedBuckets(os.environ['RATE_LIMIT_SHARED_FILE'])
 
 jwt = JWT(app, authenticate, identity) # /auth
+jwt.jwt_payload_handler(jwt_payload) # exact issue times, for the revocation check
+init_revocations(app) # after JWT(app), which sets the expiry defaults
 
 api.add_resource(Store, '/store/<string:name>')
 api.add_resource(Item, '/item/<string:name>')
 api.add_resource(ItemList, '/items')
+api.add_resource(ItemExport, '/items/export')
 api.add_resource(StoreList, '/stores')
+api.add_resource(StoreItems, '/store/<string:name>/items')
+api.add_resource(StoreSummary, '/store/<string:name>/summary')
+api.add_resource(StoreSummaryList, '/stores/summary')
+api.add_resource(ChangeList, '/changes')
 
 api.add_resource(UserRegister, '/register')
+api.add_resource(UserLogout, '/logout')
+api.add_resource(Metrics, '/metrics')
+api.add_resource(PoolStats, '/metrics/pool')
+api.add_resource(ProfileStats, '/metrics/profile')
 
 @app.errorhandler(JWTError) # whenever JWT err gets raised inside app the auth_error_handler is going to be called
 def auth_error_handler(err):
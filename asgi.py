@@ -0,0 +1,403 @@
+"""
+ASGI entry point serving the same routes as app.py with async handlers and an async database session,
+so one process keeps many requests in flight while they wait on the database:
+
+    uvicorn asgi:app
+
+Needs an ASGI server (e.g. uvicorn) and an async driver: asyncpg for PostgreSQL, aiosqlite for SQLite.
+Models and JWT settings are shared with the Flask app; /auth tokens work for both.
+"""
+import asyncio
+import json
+import os
+import re
+from urllib.parse import parse_qs
+
+import jwt as pyjwt
+from flask_jwt import JWTError
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags
+
+from app import app as flask_app, jwt
+from cache import response_cache
+from db import db
+from models.item import ItemModel, VersionConflict, on_conflict_insert
+from models.store import StoreModel
+from models.user import UserModel, identity_cache
+from passwords import hash_password, needs_rehash, verify_password
+from security import is_revoked
+from resources.item import SORT_COLUMNS, clean_bulk_row, if_match_version, search_parser
+from resources.pagination import DEFAULT_LIMIT, MAX_LIMIT, after_key, decode_cursor, encode_cursor, parse_query
+from serializers import serializer
+
+AUTH_ERROR = {'message': 'Could not authorize. Did you included a valid Authorization header?'} # same as app.auth_error_handler
+
+
+def async_database_uri(uri):
+    """
+    Picks the async driver for the DATABASE_URL the Flask app uses.
+    """
+    uri = re.sub(r'^postgres(ql)?://', 'postgresql+asyncpg://', uri)
+    return re.sub(r'^sqlite://', 'sqlite+aiosqlite://', uri)
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {key: values[-1] for key, values in parse_qs(scope['query_string'].decode()).items()}
+        self.headers = {key.decode().lower(): value.decode() for key, value in scope['headers']}
+        self.body = body
+
+    def json(self):
+        try:
+            return json.loads(self.body or b'null')
+        except ValueError:
+            return None
+
+
+class AsyncApi:
+    """
+    A small ASGI application: routes are (method, path regex, handler) and every handler
+    gets the request, an AsyncSession and the path parameters, and returns (payload, status) or (payload, status, headers).
+    """
+    def __init__(self, database_uri):
+        self.engine = create_async_engine(async_database_uri(database_uri))
+        self.session_factory = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.routes = [
+            ('GET', r'/store/(?P<name>[^/]+)', self.get_store),
+            ('POST', r'/store/(?P<name>[^/]+)', self.post_store),
+            ('DELETE', r'/store/(?P<name>[^/]+)', self.delete_store),
+            ('GET', r'/stores', self.get_stores),
+            ('GET', r'/item/(?P<name>[^/]+)', self.get_item),
+            ('POST', r'/item/(?P<name>[^/]+)', self.post_item),
+            ('DELETE', r'/item/(?P<name>[^/]+)', self.delete_item),
+            ('PUT', r'/item/(?P<name>[^/]+)', self.put_item),
+            ('GET', r'/items', self.get_items),
+            ('PUT', r'/items', self.put_items),
+            ('POST', r'/register', self.register),
+            ('POST', r'/auth', self.auth),
+        ]
+
+    async def create_tables(self):
+        async with self.engine.begin() as connection:
+            await connection.run_sync(db.metadata.create_all)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        request = Request(scope, body)
+
+        payload, status, *headers = await self.dispatch(request)
+        headers = [(key.lower().encode(), value.encode()) for key, value in (headers[0] if headers else {}).items()]
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': [(b'content-type', b'application/json')] + headers})
+        await send({'type': 'http.response.body', 'body': serializer.dumps(payload) + b'\n'})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.create_tables() # like run.py does before the first request
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, request):
+        allowed = False
+        for method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, request.path)
+            if not match:
+                continue
+            if method != request.method:
+                allowed = True
+                continue
+            async with self.session_factory() as session:
+                try:
+                    return await handler(request, session, **match.groupdict())
+                except JWTError:
+                    return AUTH_ERROR, 401
+                except HTTPException as e: # e.g. decode_cursor aborting on a bad cursor
+                    return getattr(e, 'data', None) or {'message': e.description}, e.code
+        if allowed:
+            return {'message': 'The method is not allowed for the requested URL.'}, 405
+        return {'message': 'The requested URL was not found on the server.'}, 404
+
+    # helpers
+
+    def page_args(self, request):
+        try:
+            limit = int(request.args.get('limit', DEFAULT_LIMIT))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= MAX_LIMIT:
+            return None, {'message': {'limit': "limit must be between 1 and {}.".format(MAX_LIMIT)}}
+        return limit, None
+
+    async def page(self, session, model, request, limit, filters=(), sort_column=None, descending=False):
+        """
+        The async twin of resources.pagination.paginate, over the record_columns() rows of the model.
+        """
+        columns = [sort_column, model.id] if sort_column is not None else [model.id]
+        query = select(*model.record_columns()).where(*filters).order_by(*[c.desc() if descending else c.asc() for c in columns])
+        if request.args.get('after') is not None:
+            last_key = decode_cursor(request.args['after'], columns)
+            query = query.where(after_key(columns, last_key, descending))
+        rows = (await session.execute(query.limit(limit + 1))).all()
+        if len(rows) > limit:
+            return rows[:limit], encode_cursor([getattr(rows[limit - 1], c.key) for c in columns])
+        return rows, None
+
+    async def stores_json(self, session, stores):
+        """
+        The async twin of StoreModel.json_many: one query for all the items of the stores.
+        """
+        items_by_store = {store.id: [] for store in stores}
+        if items_by_store:
+            items = await session.execute(select(*ItemModel.record_columns()).where(ItemModel.store_id.in_(items_by_store.keys())).order_by(ItemModel.id))
+            for item in items:
+                items_by_store[item.store_id].append(ItemModel.record_json(item))
+        return [{'name': store.name, 'items': items_by_store[store.id]} for store in stores]
+
+    async def find_by(self, session, column, value):
+        return (await session.execute(select(column.class_).where(column == value))).scalars().first()
+
+    def item_args(self, request):
+        data = request.json()
+        data = data if isinstance(data, dict) else {}
+        errors = {}
+        try:
+            price = float(data['price'])
+        except (KeyError, TypeError, ValueError):
+            errors['price'] = 'This field cannot be left blank!'
+        try:
+            store_id = int(data['store_id'])
+        except (KeyError, TypeError, ValueError):
+            errors['store_id'] = 'Every item needs a store id.'
+        if errors:
+            return None, {'message': errors}
+        return {'price': price, 'store_id': store_id}, None
+
+    async def current_identity(self, request, session):
+        """
+        Same checks as security.jwt_required() followed by security.identity.
+        """
+        parts = request.headers.get('authorization', '').split()
+        if len(parts) != 2 or parts[0].lower() != flask_app.config['JWT_AUTH_HEADER_PREFIX'].lower():
+            raise JWTError('Authorization Required', 'Request does not contain a valid access token')
+        try:
+            with flask_app.app_context():
+                payload = jwt.jwt_decode_callback(parts[1])
+        except pyjwt.InvalidTokenError as e:
+            raise JWTError('Invalid token', str(e))
+        if is_revoked(payload):
+            raise JWTError('Invalid token', 'Token has been revoked')
+        if flask_app.config.get('JWT_LAZY_IDENTITY'):
+            return payload # the handlers only need an authenticated caller
+        user = identity_cache.get(payload['identity'])
+        if user is None:
+            user = await session.get(UserModel, payload['identity'])
+            if user is None:
+                raise JWTError('Invalid JWT', 'User does not exist')
+            identity_cache.set(user.id, user.detached_copy())
+        return user
+
+    async def commit(self, session, keys):
+        await session.commit()
+        response_cache.invalidate(*keys) # the Flask workers may share the cache
+
+    # /store/<name>
+
+    async def get_store(self, request, session, name):
+        store = await self.find_by(session, StoreModel.name, name)
+        if store:
+            return (await self.stores_json(session, [store]))[0], 200
+        return {'message': 'Store not found'}, 404
+
+    async def post_store(self, request, session, name):
+        if await self.find_by(session, StoreModel.name, name):
+            return {'message': "A store with name '{}' already exists.".format(name)}, 400
+        session.add(StoreModel(name))
+        try:
+            await self.commit(session, StoreModel.cache_keys(name))
+        except IntegrityError:
+            return {'message': "A store with name '{}' already exists.".format(name)}, 400
+        return {'name': name, 'items': []}, 201
+
+    async def delete_store(self, request, session, name):
+        store = await self.find_by(session, StoreModel.name, name)
+        if store:
+            await session.delete(store)
+            await self.commit(session, StoreModel.cache_keys(name))
+        return {'message': 'Store deleted'}, 200
+
+    async def get_stores(self, request, session):
+        if request.args.get('all', '').lower() in ('true', '1', 'yes'):
+            stores = (await session.execute(select(*StoreModel.record_columns()).order_by(StoreModel.id))).all()
+            return {'stores': await self.stores_json(session, stores)}, 200
+        limit, error = self.page_args(request)
+        if error:
+            return error, 400
+        stores, next_cursor = await self.page(session, StoreModel, request, limit)
+        return {'stores': await self.stores_json(session, stores), 'next': next_cursor}, 200
+
+    # /item/<name>
+
+    async def get_item(self, request, session, name):
+        await self.current_identity(request, session)
+        item = await self.find_by(session, ItemModel.name, name)
+        if item:
+            return item.json(), 200, {'ETag': '"{}"'.format(ItemModel.etag(item.json(), item.version))}
+        return {'message': 'Item not found'}, 404
+
+    async def post_item(self, request, session, name):
+        """
+        Same as Item.post: one INSERT ... ON CONFLICT DO NOTHING, see ItemModel.insert.
+        """
+        data, error = self.item_args(request)
+        if error:
+            return error, 400
+        try:
+            keys = await session.run_sync(ItemModel.insert_statements, name, data['price'], data['store_id'])
+            if keys is not None:
+                await self.commit(session, keys)
+        except IntegrityError:
+            if await session.run_sync(on_conflict_insert, ItemModel.__table__) is not None:
+                raise # the name conflict is handled by ON CONFLICT, this is another constraint
+            keys = None
+        if keys is None:
+            return {'message': "An item with name '{}' already exists.".format(name)}, 400
+        payload = {'name': name, 'price': data['price']}
+        return payload, 201, {'ETag': '"{}"'.format(ItemModel.etag(payload, 1))}
+
+    async def delete_item(self, request, session, name):
+        """
+        Same as Item.delete: one DELETE by name, see ItemModel.delete_by_name.
+        """
+        keys = await session.run_sync(ItemModel.delete_statements, name)
+        if keys is not None:
+            await self.commit(session, keys)
+        return {'message': 'Item deleted'}, 200
+
+    async def put_item(self, request, session, name):
+        """
+        Same as Item.put: one atomic upsert, checking If-Match, see ItemModel.upsert.
+        """
+        data, error = self.item_args(request)
+        if error:
+            return error, 400
+        if_match = parse_etags(request.headers.get('if-match'))
+        expected_version, error = if_match_version(if_match)
+        if error:
+            return error, 412
+        try:
+            version, keys = await session.run_sync(ItemModel.upsert_statements, name, data['price'], data['store_id'],
+                                                   expected_version, not if_match)
+        except VersionConflict:
+            return {'message': "The item '{}' was changed by another request.".format(name)}, 412
+        await self.commit(session, keys)
+        payload = {'name': name, 'price': data['price']}
+        return payload, 200, {'ETag': '"{}"'.format(ItemModel.etag(payload, version))}
+
+    # /items
+
+    async def get_items(self, request, session):
+        args = parse_query(search_parser, request.args) # same validation and messages as ItemList.get
+        filters = ItemModel.search_filters(args['prefix'], args['min_price'], args['max_price'], args['store_id'])
+        descending = args['sort'].startswith('-')
+        sort_column = SORT_COLUMNS[args['sort'].lstrip('-')]
+        if args['all']:
+            order = [c.desc() if descending else c for c in (sort_column, ItemModel.id) if c is not None]
+            items = (await session.execute(select(*ItemModel.record_columns()).where(*filters).order_by(*order))).all()
+            return {'items': [ItemModel.record_json(item) for item in items]}, 200
+        items, next_cursor = await self.page(session, ItemModel, request, args['limit'], filters, sort_column, descending)
+        return {'items': [ItemModel.record_json(item) for item in items], 'next': next_cursor}, 200
+
+    async def put_items(self, request, session):
+        """
+        Same as ItemList.put, in a single transaction, see ItemModel.bulk_upsert.
+        """
+        rows = request.json()
+        if not isinstance(rows, list):
+            return {'message': 'Expected a JSON array of items.'}, 400
+        results = []
+        valid_rows = {}
+        for row in rows:
+            data, error = clean_bulk_row(row)
+            if data and data['name'] in valid_rows:
+                data, error = None, 'Duplicated item name.'
+            if error:
+                results.append({'name': row.get('name') if isinstance(row, dict) else None, 'status': 'error', 'message': error})
+            else:
+                valid_rows[data['name']] = data
+                results.append({'name': data['name']})
+
+        existing = set()
+        try:
+            if valid_rows:
+                existing, keys = await session.run_sync(ItemModel.bulk_upsert_statements, list(valid_rows.values()))
+                await self.commit(session, keys)
+            status = None
+        except IntegrityError:
+            status = 'error'
+        for result in results:
+            if 'status' not in result:
+                result['status'] = status or ('updated' if result['name'] in existing else 'created')
+                if status:
+                    result['message'] = 'An error occurred writing the item.'
+        return {'items': results}, 200
+
+    # /register and /auth
+
+    async def register(self, request, session):
+        data = request.json()
+        data = data if isinstance(data, dict) else {}
+        for field in ('username', 'password'):
+            if not isinstance(data.get(field), str):
+                return {'message': {field: 'This field cannot be blank.'}}, 400
+        if await self.find_by(session, UserModel.username, data['username']):
+            return {'message': 'A user with that username already exist'}, 400
+        user = UserModel(data['username'], await asyncio.to_thread(hash_password, data['password']))
+        session.add(user)
+        try:
+            await session.commit()
+        except IntegrityError:
+            return {'message': 'A user with that username already exist'}, 400
+        identity_cache.delete(user.id) # like UserModel.save_to_db
+        return {'message': 'User created successfully.'}, 201
+
+    async def auth(self, request, session):
+        """
+        Same as flask_jwt's /auth with security.authenticate.
+        """
+        data = request.json()
+        if not isinstance(data, dict) or len(data) != 2 or not data.get('username') or not data.get('password'):
+            raise JWTError('Bad Request', 'Invalid credentials')
+        user = await self.find_by(session, UserModel.username, data['username'])
+        if not user or not await asyncio.to_thread(verify_password, data['password'], user.password):
+            raise JWTError('Bad Request', 'Invalid credentials')
+        if needs_rehash(user.password):
+            user.password = await asyncio.to_thread(hash_password, data['password'])
+            await session.commit()
+            identity_cache.delete(user.id)
+        with flask_app.app_context():
+            access_token = jwt.jwt_encode_callback(user)
+        return {'access_token': access_token.decode('utf-8')}, 200
+
+
+app = AsyncApi(os.environ.get('DATABASE_URL', 'sqlite:///data.db'))
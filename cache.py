@@ -0,0 +1,187 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import Response, request
+
+
+class TTLCache:
+    """
+    Small thread-safe in-process cache: entries expire after ttl seconds and
+    the least recently used entry is evicted once maxsize is reached.
+    """
+    def __init__(self, maxsize=1024, ttl=300, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (expires at, value), oldest first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.timer():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.timer() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def add(self, key, value):
+        """
+        Like set, but never evicts an entry before it expires: when the cache is full of live entries the value isn't stored.
+        :return: True if the value was stored.
+        """
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.maxsize:
+                now = self.timer()
+                for expired in [k for k, (expires_at, v) in self._entries.items() if expires_at <= now]:
+                    del self._entries[expired]
+                if len(self._entries) >= self.maxsize:
+                    return False
+            self._entries[key] = (self.timer() + self.ttl, value)
+            self._entries.move_to_end(key)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class RedisCache:
+    """
+    Cache backend for a Redis server, or anything speaking the same get/set/delete/scan_iter API.
+    Values are stored as JSON, so they must be JSON serializable.
+    """
+    def __init__(self, client, ttl=300, prefix='stores-rest-api:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        raw = self.client.get(self.prefix + str(key))
+        if raw is None:
+            return default
+        return json.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + str(key), json.dumps(value), ex=math.ceil(self.ttl))
+        return value
+
+    def add(self, key, value):
+        """
+        Like TTLCache.add; Redis has no maxsize, so the value is always stored.
+        """
+        self.set(key, value)
+        return True
+
+    def delete(self, key):
+        self.client.delete(self.prefix + str(key))
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def make_etag(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Read-through cache of GET payloads keyed by resource (e.g. 'item:<name>'), stored together with their ETag.
+    The backend is anything with get/set/delete/clear, TTLCache by default or RedisCache.
+    The models invalidate their keys whenever they are saved or deleted. Every invalidation also renews the key's
+    generation, so a payload read before a write but stored after its invalidation is dropped (see set).
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, key):
+        """
+        :return: A (payload, etag) pair, or None if the key isn't cached.
+        """
+        entry = self.backend.get(key)
+        return tuple(entry) if entry is not None else None
+
+    def generation(self, key):
+        """
+        Read it before reading the payload to cache, and pass it to set.
+        """
+        return self.backend.get('generation:' + key, '')
+
+    def set(self, key, payload, etag=None, store=True, generation=None):
+        """
+        :param etag: The ETag of the payload, a hash of it by default.
+        :param store: False to only build the entry, e.g. for a payload read from a replica, which may be behind
+                      the writes whose invalidations already happened.
+        :param generation: generation(key) from before the payload was read: if the key was invalidated since,
+                           the payload may predate the write and isn't kept.
+        :return: The (payload, etag) pair.
+        """
+        entry = (payload, etag or make_etag(payload))
+        if store and (generation is None or self.generation(key) == generation):
+            self.backend.set(key, entry)
+            if generation is not None and self.generation(key) != generation: # invalidated while we were storing
+                self.backend.delete(key)
+        return entry
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.backend.set('generation:' + key, uuid.uuid4().hex) # before the delete, see set
+            self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+
+def not_modified(etag):
+    """
+    :return: A 304 response without a body when the client already has this version (If-None-Match), None otherwise.
+    """
+    if request.if_none_match.contains_weak(etag): # compressed responses carry the weak form, see compression.Compressor
+        return Response(status=304, headers={'ETag': '"{}"'.format(etag)})
+    return None
+
+
+def etag_header(etag):
+    """
+    :return: The headers for this ETag, none without one.
+    """
+    return {'ETag': '"{}"'.format(etag)} if etag else {}
+
+
+def conditional_response(payload, etag):
+    """
+    Answers 304 without a body when the client already has this version (If-None-Match),
+    the payload with its ETag otherwise.
+    """
+    return not_modified(etag) or (payload, 200, etag_header(etag))
+
+
+response_cache = ResponseCache(TTLCache(maxsize=int(os.environ.get('RESPONSE_CACHE_SIZE', 10000)),
+                                        ttl=float(os.environ.get('RESPONSE_CACHE_TTL', 300))))
@@ -0,0 +1,183 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from db import db
+
+
+class GroupCommitter:
+    """
+    Optional group commit: with GROUP_COMMIT_WINDOW (seconds) set, the writes of concurrent requests are handed
+    to one background thread which runs everything arriving within the window (at most GROUP_COMMIT_MAX_BATCH writes)
+    in a single transaction, so the database flushes its log once per batch instead of once per request.
+    A write which fails is left out and the rest of the batch is run again, so one request's error never fails another.
+    Without the setting every write commits in db.session as before.
+    """
+    def __init__(self, window=0, max_batch=100):
+        self.window = window
+        self.max_batch = max_batch
+        self.app = None
+        self.batches = 0
+        self.operations = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.window = app.config.get('GROUP_COMMIT_WINDOW', self.window)
+        self.max_batch = app.config.get('GROUP_COMMIT_MAX_BATCH', self.max_batch)
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.window > 0
+
+    # writes
+
+    def run(self, work):
+        """
+        Runs work(session) and commits, through the committer thread when group commit is enabled.
+        work may run more than once (when another write of its batch fails), so it must only use the session.
+        :return: What work returned, once it is committed.
+        """
+        if self.enabled:
+            return self.enqueue(work).result()
+        try:
+            result = work(db.session())
+            db.session.commit()
+        except:
+            db.session.rollback() # leave the session usable after e.g. a unique constraint violation
+            raise
+        return result
+
+    def save(self, instance, keys=None):
+        """
+        Inserts or updates a model instance like db.session.add and commit would.
+        With group commit the committer writes a merged copy, then the instance is brought back into db.session
+        as persistent with the committed values.
+        :param keys: A function of the written instance, returning the cache keys to invalidate.
+        :return: The cache keys.
+        """
+        if not self.enabled:
+            def work(session):
+                session.add(instance)
+                session.flush() # e.g. relationships of new instances are only loaded once they are in the database
+                return keys(instance) if keys else []
+            return self.run(work)
+
+        columns = [attr.key for attr in inspect(instance).mapper.column_attrs]
+
+        def work(session):
+            merged = session.merge(instance)
+            session.flush()
+            return {key: getattr(merged, key) for key in columns}, keys(merged) if keys else []
+
+        values, cache_keys = self.run(work)
+        transient = inspect(instance).transient
+        for key, value in values.items():
+            set_committed_value(instance, key, value)
+        if transient:
+            make_transient_to_detached(instance)
+            db.session.add(instance)
+        return cache_keys
+
+    def delete(self, instance, keys=None):
+        """
+        Deletes a model instance like db.session.delete and commit would.
+        :param keys: A function of the instance, returning the cache keys to invalidate.
+        :return: The cache keys.
+        """
+        if not self.enabled:
+            def work(session):
+                cache_keys = keys(instance) if keys else []
+                session.delete(instance)
+                return cache_keys
+            return self.run(work)
+
+        def work(session):
+            merged = session.merge(instance)
+            cache_keys = keys(merged) if keys else []
+            session.delete(merged)
+            session.flush()
+            return cache_keys
+
+        cache_keys = self.run(work)
+        if inspect(instance).session is not None:
+            db.session.expunge(instance)
+        return cache_keys
+
+    # the committer thread
+
+    def enqueue(self, work):
+        """
+        :return: A Future with the result (or the exception) of work(session), set after the commit of its batch.
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive(): # started once, or again if it ever died
+                self._thread = threading.Thread(target=self._loop, name='group-commit', daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((work, future))
+        return future
+
+    def _loop(self):
+        with self.app.app_context():
+            while True:
+                batch = [self._queue.get()]
+                deadline = time.monotonic() + self.window # the first write waits at most one window for company
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                    except queue.Empty:
+                        break
+                try:
+                    self.commit_batch(batch)
+                except Exception as e: # e.g. the rollback failing on a lost connection: the thread must go on
+                    for work, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+
+    def commit_batch(self, batch):
+        """
+        Runs a batch of (work, future) in one transaction, leaving out the writes which fail.
+        """
+        pending = list(batch)
+        while pending:
+            session = db.create_session({})()
+            results = []
+            try:
+                for work, future in pending:
+                    try:
+                        results.append(work(session))
+                        session.flush()
+                    except Exception as e:
+                        session.rollback()
+                        future.set_exception(e)
+                        pending.remove((work, future))
+                        break
+                else:
+                    try:
+                        session.commit()
+                    except Exception as e:
+                        session.rollback()
+                        if len(pending) == 1:
+                            pending[0][1].set_exception(e)
+                        else: # we can't tell whose write failed, so everybody commits alone
+                            for item in pending:
+                                self.commit_batch([item])
+                        return
+                    self.batches += 1
+                    self.operations += len(pending)
+                    for (work, future), result in zip(pending, results):
+                        future.set_result(result)
+                    return
+            finally:
+                session.close()
+
+
+committer = GroupCommitter()
@@ -0,0 +1,82 @@
+import gzip
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError: # optional, gzip only without it
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/plain', 'text/html'}
+BROTLI_QUALITY = 5 # of 11, about as fast as gzip level 6 and smaller
+
+
+class Compressor:
+    """
+    Compresses JSON responses of at least COMPRESS_MIN_SIZE bytes with the encoding the client prefers
+    (Accept-Encoding): br when the brotli package is installed, gzip otherwise. Catalog listings shrink
+    several times over; smaller responses aren't worth the CPU.
+    Streamed responses (/items/export) are gzipped on the fly, so they still never sit in memory whole.
+    A compressed response's ETag becomes weak, it is no longer the same bytes (If-Match keeps working on the rest).
+    """
+    def __init__(self, min_size=1024, level=6):
+        self.min_size = min_size
+        self.level = level
+        self.enabled = True
+
+    def init_app(self, app):
+        self.enabled = app.config.get('COMPRESS_RESPONSES', self.enabled)
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', self.min_size)
+        self.level = app.config.get('COMPRESS_LEVEL', self.level)
+        app.after_request(self.finish_request)
+
+    @property
+    def encodings(self):
+        """
+        The supported encodings, best first.
+        """
+        return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    def compress(self, data, encoding):
+        if encoding == 'br':
+            return brotli.compress(data, quality=BROTLI_QUALITY)
+        return gzip.compress(data, compresslevel=self.level, mtime=0) # mtime=0: the same body always compresses the same
+
+    def compress_stream(self, chunks):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip framing
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data: # zlib holds small chunks back until it has a block's worth
+                yield data
+        yield compressor.flush()
+
+    def finish_request(self, response):
+        if (not self.enabled or response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers
+                or response.status_code < 200 or response.status_code in (204, 304)):
+            return response
+        response.vary.add('Accept-Encoding')
+
+        if response.is_streamed:
+            if request.accept_encodings.best_match(['gzip']) is None:
+                return response
+            chunks = response.response
+            response.response = self.compress_stream(response.iter_encoded())
+            if hasattr(chunks, 'close'): # e.g. stream_with_context's cleanup
+                response.call_on_close(chunks.close)
+            response.headers.pop('Content-Length', None)
+            encoding = 'gzip'
+        else:
+            encoding = request.accept_encodings.best_match(self.encodings)
+            if encoding is None or response.calculate_content_length() < self.min_size:
+                return response
+            response.set_data(self.compress(response.get_data(), encoding))
+
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+compressor = Compressor()
@@ -1,3 +1,48 @@
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
 
-db = SQLAlchemy()
+from metrics import InstrumentedQueuePool
+
+
+class RoutingSession(SignallingSession):
+    """
+    Runs the queries of read-only requests on the replica chosen for them (g.replica, see replicas.ReplicaRouter);
+    flushes and everything else use the primary.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and not self._flushing:
+            replica = g.get('replica')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+POOL_SETTINGS = { # environment variable -> (create_engine argument, type)
+    'DB_POOL_SIZE': ('pool_size', int),
+    'DB_MAX_OVERFLOW': ('max_overflow', int),
+    'DB_POOL_TIMEOUT': ('pool_timeout', float),
+    'DB_POOL_RECYCLE': ('pool_recycle', int),
+    'DB_POOL_PRE_PING': ('pool_pre_ping', lambda value: value.lower() in ('1', 'true', 'yes')),
+}
+
+
+def engine_options(database_uri, environ):
+    """
+    Builds SQLALCHEMY_ENGINE_OPTIONS from the DB_POOL_* environment variables;
+    the ones which aren't set keep SQLAlchemy's defaults.
+    :param database_uri: The SQLALCHEMY_DATABASE_URI.
+    :param environ: A mapping like os.environ.
+    :return: A dictionary of create_engine arguments.
+    """
+    options = {argument: convert(environ[variable]) for variable, (argument, convert) in POOL_SETTINGS.items() if variable in environ}
+    if not database_uri.startswith('sqlite'): # SQLite pools are special (one connection per thread, or per file access)
+        options['poolclass'] = InstrumentedQueuePool
+    return options
@@ -0,0 +1,238 @@
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import Pool, QueuePool
+
+
+class Histogram:
+    """
+    Counts observations (in seconds) into fixed buckets, like a Prometheus histogram.
+    """
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """
+        :return: A dictionary with the cumulative count of every bucket (by upper bound), sum and count.
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        buckets = {}
+        cumulative = 0
+        for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], counts):
+            cumulative += bucket_count
+            buckets[str(bound)] = cumulative
+        return {'buckets': buckets, 'sum': total, 'count': count}
+
+
+def merge_histograms(first, second):
+    """
+    Adds up two Histogram snapshots with the same buckets, e.g. from two worker processes.
+    """
+    return {'buckets': {bound: count + second['buckets'].get(bound, 0) for bound, count in first['buckets'].items()},
+            'sum': first['sum'] + second['sum'],
+            'count': first['count'] + second['count']}
+
+
+class PoolMetrics:
+    """
+    Connection pool activity of every SQLAlchemy engine in the process: connection churn
+    (connects/closes), checkouts and, for InstrumentedQueuePool, how long checkouts waited.
+    """
+    COUNTERS = ('connects', 'closes', 'invalidations', 'checkouts', 'checkins', 'checkout_timeouts')
+
+    def __init__(self):
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.checkout_wait = Histogram()
+        self._lock = threading.Lock()
+
+    def increment(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def install(self):
+        event.listen(Pool, 'connect', lambda *args: self.increment('connects'))
+        event.listen(Pool, 'close', lambda *args: self.increment('closes'))
+        event.listen(Pool, 'close_detached', lambda *args: self.increment('closes'))
+        event.listen(Pool, 'invalidate', lambda *args: self.increment('invalidations'))
+        event.listen(Pool, 'checkout', lambda *args: self.increment('checkouts'))
+        event.listen(Pool, 'checkin', lambda *args: self.increment('checkins'))
+
+    def snapshot(self, pool):
+        """
+        :param pool: The pool of the engine to report on, e.g. db.engine.pool.
+        :return: A dictionary with the counters, the checkout wait histogram and the current state of the pool.
+        """
+        with self._lock:
+            result = dict(self.counters)
+        result['checkout_wait_seconds'] = self.checkout_wait.snapshot()
+        result['pool'] = {'class': type(pool).__name__, 'status': pool.status()}
+        if isinstance(pool, QueuePool):
+            result['pool'].update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow(),
+                                  idle=pool.checkedin())
+        return result
+
+
+pool_metrics = PoolMetrics()
+pool_metrics.install()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool which times every checkout, so we can see workers waiting for a connection.
+    """
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.increment('checkout_timeouts')
+            raise
+        finally:
+            pool_metrics.checkout_wait.observe(time.perf_counter() - start)
+
+
+class RequestMetrics:
+    """
+    Request count per endpoint, method and status code and latency histograms per endpoint and method,
+    rendered in the Prometheus text format by GET /metrics.
+    With several worker processes set METRICS_MULTIPROC_DIR to a directory shared by them: every process
+    writes its numbers there (at most every METRICS_FLUSH_SECONDS) and /metrics adds them all up.
+    """
+    def __init__(self):
+        self.requests = {} # (endpoint, method, status) -> count
+        self.latency = {} # (endpoint, method) -> Histogram
+        self.multiprocess_dir = None
+        self.flush_seconds = 1.0
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.multiprocess_dir = app.config.get('METRICS_MULTIPROC_DIR')
+        self.flush_seconds = app.config.get('METRICS_FLUSH_SECONDS', 1.0)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request) # also runs for error handler responses, e.g. the 401s of auth_error_handler
+
+    def start_request(self):
+        g.metrics_start = time.perf_counter()
+
+    def finish_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            self.observe(request.endpoint or 'unmatched', request.method, response.status_code, time.perf_counter() - start)
+        return response
+
+    def observe(self, endpoint, method, status, seconds):
+        counter_key = (endpoint, method, status)
+        with self._lock:
+            self.requests[counter_key] = self.requests.get(counter_key, 0) + 1
+            histogram = self.latency.get(counter_key[:2])
+            if histogram is None:
+                histogram = self.latency[counter_key[:2]] = Histogram()
+        histogram.observe(seconds)
+        if self.multiprocess_dir and time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+
+    def state(self):
+        """
+        :return: The numbers of this process as a JSON serializable dictionary.
+        """
+        with self._lock:
+            requests = dict(self.requests)
+            latency = dict(self.latency)
+        with pool_metrics._lock:
+            pool = dict(pool_metrics.counters)
+        return {'requests': {'{} {} {}'.format(*key): count for key, count in requests.items()},
+                'latency': {'{} {}'.format(*key): histogram.snapshot() for key, histogram in latency.items()},
+                'pool': pool,
+                'pool_checkout_wait': pool_metrics.checkout_wait.snapshot()}
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        path = os.path.join(self.multiprocess_dir, 'metrics-{}.json'.format(os.getpid()))
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.state(), f)
+        os.replace(path + '.tmp', path) # readers never see a half written file
+
+    def collect(self):
+        """
+        :return: The state of this process added up with the ones the other processes wrote.
+        """
+        total = self.state()
+        if not self.multiprocess_dir:
+            return total
+        self.flush()
+        own = os.path.join(self.multiprocess_dir, 'metrics-{}.json'.format(os.getpid()))
+        for path in glob.glob(os.path.join(self.multiprocess_dir, 'metrics-*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as f:
+                    other = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for key, count in other['requests'].items():
+                total['requests'][key] = total['requests'].get(key, 0) + count
+            for key, histogram in other['latency'].items():
+                total['latency'][key] = merge_histograms(total['latency'][key], histogram) if key in total['latency'] else histogram
+            for key, count in other['pool'].items():
+                total['pool'][key] = total['pool'].get(key, 0) + count
+            total['pool_checkout_wait'] = merge_histograms(total['pool_checkout_wait'], other['pool_checkout_wait'])
+        return total
+
+    def render(self):
+        """
+        :return: All the metrics in the Prometheus text exposition format.
+        """
+        state = self.collect()
+        lines = ['# HELP http_requests_total Requests by endpoint, method and status code.',
+                 '# TYPE http_requests_total counter']
+        for key, count in sorted(state['requests'].items()):
+            endpoint, method, status = key.split(' ')
+            lines.append('http_requests_total{{endpoint="{}",method="{}",status="{}"}} {}'.format(endpoint, method, status, count))
+
+        lines += ['# HELP http_request_duration_seconds Request latency by endpoint and method.',
+                  '# TYPE http_request_duration_seconds histogram']
+        for key, histogram in sorted(state['latency'].items()):
+            endpoint, method = key.split(' ')
+            lines += render_histogram('http_request_duration_seconds', 'endpoint="{}",method="{}"'.format(endpoint, method), histogram)
+
+        for counter, count in sorted(state['pool'].items()):
+            lines += ['# TYPE db_pool_{}_total counter'.format(counter), 'db_pool_{}_total {}'.format(counter, count)]
+        lines += ['# HELP db_pool_checkout_wait_seconds Time spent waiting for a pooled connection.',
+                  '# TYPE db_pool_checkout_wait_seconds histogram']
+        lines += render_histogram('db_pool_checkout_wait_seconds', '', state['pool_checkout_wait'])
+        return '\n'.join(lines) + '\n'
+
+
+def render_histogram(name, labels, histogram):
+    separator = ',' if labels else ''
+    lines = ['{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, separator, bound, count) for bound, count in histogram['buckets'].items()]
+    labels = '{{{}}}'.format(labels) if labels else ''
+    lines.append('{}_sum{} {}'.format(name, labels, histogram['sum']))
+    lines.append('{}_count{} {}'.format(name, labels, histogram['count']))
+    return lines
+
+
+request_metrics = RequestMetrics()
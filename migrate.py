@@ -0,0 +1,77 @@
+"""
+Brings an existing database up to date with the models: creates missing tables,
+adds new columns (e.g. items.version) and the indexes declared on the columns (e.g. the unique name indexes).
+Run it once after deploying a new version: python migrate.py
+"""
+from sqlalchemy import func, inspect
+from sqlalchemy.schema import CreateColumn
+
+from app import app
+from db import db
+from models.item import NAME_PATTERN_INDEX
+
+
+def find_duplicates(columns):
+    """
+    Unique indexes can't be created while the table holds duplicates, so we report them first.
+    :param columns: The columns of the unique index.
+    :return: A list of duplicated value tuples.
+    """
+    query = db.session.query(*columns).group_by(*columns).having(func.count() > 1)
+    return [tuple(row) for row in query.all()]
+
+
+def add_missing_columns(table):
+    """
+    create_all doesn't touch existing tables, so columns added to a model later are added here,
+    with their server default filling the existing rows.
+    """
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    for column in table.columns:
+        if column.name not in existing:
+            definition = CreateColumn(column).compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql('ALTER TABLE {} ADD COLUMN {}'.format(table.name, definition))
+            print("Added {}.{}".format(table.name, column.name))
+
+
+def drop_obsolete_indexes():
+    """
+    Drops the item indexes of earlier versions which other indexes now cover, every write paid for them.
+    """
+    obsolete = ['ix_items_store_id'] # ix_items_store_id_price starts with store_id
+    if db.engine.dialect.name != 'postgresql':
+        obsolete.append('ix_items_name_pattern') # a plain copy of ix_items_name without varchar_pattern_ops
+    existing = {index['name'] for index in inspect(db.engine).get_indexes('items')}
+    for name in obsolete:
+        if name in existing:
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql('DROP INDEX {}'.format(name))
+            print("Dropped {}".format(name))
+
+
+def migrate():
+    db.create_all() # only creates the tables which don't exist yet
+    drop_obsolete_indexes()
+
+    for table in db.metadata.sorted_tables:
+        add_missing_columns(table)
+        for index in table.indexes:
+            if index.unique:
+                duplicates = find_duplicates(list(index.columns))
+                if duplicates:
+                    print("Skipping {}: duplicated values {}".format(index.name, duplicates))
+                    continue
+            index.create(bind=db.engine, checkfirst=True)
+            print("{} is up to date".format(index.name))
+
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.begin() as connection:
+            connection.execute(NAME_PATTERN_INDEX)
+        print("ix_items_name_pattern is up to date")
+
+
+if __name__ == '__main__':
+    db.init_app(app)
+    with app.app_context():
+        migrate()
@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event, literal_column, tuple_
+from sqlalchemy.orm import Session
+
+from db import db
+
+CHANGES_RETENTION = float(os.environ.get('CHANGES_RETENTION', 7 * 24 * 3600)) # seconds the change log keeps a change
+PRUNE_INTERVAL = 3600 # seconds between two prunings by the same process
+
+# PostgreSQL 13+: the id of the writing transaction, and the oldest transaction still running (every older one has ended)
+CURRENT_XACT_ID = literal_column('pg_current_xact_id()::text::bigint')
+SNAPSHOT_XMIN = literal_column('pg_snapshot_xmin(pg_current_snapshot())::text::bigint')
+
+
+class ChangeFeed:
+    """
+    Wakes up the /changes long polls of this process when a transaction with changes commits.
+    Writes committed by other processes are seen at the next poll, see resources.change.ChangeList.
+    """
+    def __init__(self):
+        self.seq = 0 # bumped by every commit with changes
+        self.next_prune = 0 # time.monotonic() of the next pruning
+        self._condition = threading.Condition()
+
+    def notify(self):
+        with self._condition:
+            self.seq += 1
+            self._condition.notify_all()
+
+    def wait(self, seq, timeout):
+        """
+        :param seq: The self.seq the caller last saw.
+        :return: True if something was committed since.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.seq != seq, timeout)
+
+
+change_feed = ChangeFeed()
+
+
+class ChangeModel(db.Model):
+    """
+    The change log of the catalog: one row per item or store written or deleted, so sync clients can ask
+    for the changes since the last one they saw instead of downloading everything again.
+    The changes are ordered by position, (xid, seq): on PostgreSQL xid is the writing transaction and a change
+    is only listed once every transaction up to it has ended, so a change can't commit behind a client's cursor
+    (seq alone isn't in commit order, transactions draw it in one order and may commit in another).
+    SQLite has a single writer, xid is 0 and seq is in commit order.
+    ORM writes are logged by the before_flush listener below; writes through SQL statements
+    (ItemModel.insert, upsert, bulk_upsert) log themselves with log().
+    Changes older than CHANGES_RETENTION are pruned, see prune().
+    """
+    __tablename__ = 'changes'
+    __table_args__ = (db.Index('ix_changes_position', 'xid', 'seq'),
+                      {'sqlite_autoincrement': True}) # seq is never reused once pruned
+
+    seq = db.Column(db.Integer, primary_key=True)
+    xid = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    changed_at = db.Column(db.Float, nullable=False, default=time.time, server_default='0') # time.time()
+    type = db.Column(db.String(20), nullable=False) # 'item' or 'store'
+    name = db.Column(db.String(80), nullable=False)
+    action = db.Column(db.String(20), nullable=False) # 'put' or 'delete'
+    data = db.Column(db.JSON) # the written values, None for deletions
+
+    def json(self):
+        return {'seq': self.seq, 'type': self.type, 'name': self.name, 'action': self.action, 'data': self.data}
+
+    @property
+    def position(self):
+        return [self.xid, self.seq]
+
+    @classmethod
+    def log(cls, session, changes):
+        """
+        Adds change rows to the transaction of the session, and prunes the log every PRUNE_INTERVAL.
+        :param changes: An iterable of (type, name, data) tuples, data None for deletions.
+        """
+        changes = list(changes)
+        if not changes:
+            return
+        postgresql = session.get_bind().dialect.name == 'postgresql'
+        session.add_all([cls(type=type, name=name, action='put' if data is not None else 'delete', data=data,
+                             xid=CURRENT_XACT_ID if postgresql else 0)
+                         for type, name, data in changes])
+        session.info['notify_changes'] = True
+        if time.monotonic() >= change_feed.next_prune:
+            change_feed.next_prune = time.monotonic() + PRUNE_INTERVAL
+            cls.prune(session, time.time() - CHANGES_RETENTION)
+
+    @classmethod
+    def prune(cls, session, before):
+        """
+        Deletes the changes made before a time, except the newest of them: it stays as the oldest change,
+        so a client whose cursor is older can be told it missed changes (see is_pruned).
+        """
+        newest = (cls.visible(session.query(cls.xid, cls.seq), session).filter(cls.changed_at < before)
+                  .order_by(cls.xid.desc(), cls.seq.desc()).first())
+        if newest is not None:
+            session.query(cls).filter(tuple_(cls.xid, cls.seq) < tuple_(*newest)).delete(synchronize_session=False)
+
+    @classmethod
+    def visible(cls, query, session=None):
+        """
+        Filters a query down to the changes no running transaction can still commit behind: on PostgreSQL
+        the ones of transactions older than the oldest transaction running.
+        """
+        session = session or db.session()
+        if session.get_bind().dialect.name == 'postgresql':
+            query = query.filter(cls.xid < SNAPSHOT_XMIN)
+        return query
+
+    @classmethod
+    def since(cls, position, limit):
+        """
+        :param position: The position of the last change seen, None for the oldest change kept.
+        :return: At most limit changes after position, oldest first.
+        """
+        query = cls.visible(cls.query)
+        if position is not None:
+            query = query.filter(tuple_(cls.xid, cls.seq) > tuple_(*position))
+        return query.order_by(cls.xid, cls.seq).limit(limit).all()
+
+    @classmethod
+    def last_position(cls):
+        """
+        :return: The position of the newest change, None if there is none.
+        """
+        last = cls.visible(db.session.query(cls.xid, cls.seq)).order_by(cls.xid.desc(), cls.seq.desc()).first()
+        return list(last) if last is not None else None
+
+    @classmethod
+    def catalog_etag(cls):
+        """
+        The ETag of the catalog listings: the position of the newest change, so every worker derives the same one
+        from the database (on a replica, from the same data it lists). Read it before querying: a write committing
+        in between then changes the ETag, never the data behind it.
+        On PostgreSQL a write shows up in the ETag once every older transaction has ended, see visible().
+        """
+        return '{}.{}'.format(*(cls.last_position() or [0, 0]))
+
+    @classmethod
+    def is_pruned(cls, position):
+        """
+        Whether changes after position may have been pruned: the change at position itself is gone.
+        """
+        oldest = db.session.query(cls.xid, cls.seq).order_by(cls.xid, cls.seq).first()
+        return oldest is not None and list(oldest) > position
+
+
+@event.listens_for(Session, 'before_flush')
+def log_changes(session, flush_context, instances):
+    """
+    Logs the items and stores (anything with change_type and change_data()) the session is about to write or delete.
+    """
+    changes = []
+    for instance in session.new:
+        if hasattr(instance, 'change_type'):
+            changes.append((instance.change_type, instance.name, instance.change_data()))
+    for instance in session.dirty:
+        if hasattr(instance, 'change_type') and session.is_modified(instance, include_collections=False):
+            changes.append((instance.change_type, instance.name, instance.change_data()))
+    for instance in session.deleted:
+        if hasattr(instance, 'change_type'):
+            changes.append((instance.change_type, instance.name, None))
+    ChangeModel.log(session, changes)
+
+
+@event.listens_for(Session, 'after_commit')
+def notify_changes(session):
+    if session.info.pop('notify_changes', False):
+        change_feed.notify()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_changes(session):
+    session.info.pop('notify_changes', None)
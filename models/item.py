@@ -1,32 +1,313 @@
+import os
+import sys
+
+from sqlalchemy import DDL, bindparam, delete, event, insert, update
+from sqlalchemy.exc import IntegrityError
+
+from cache import make_etag, response_cache
+from committer import committer
 from db import db
+from models.change import ChangeModel
+
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+
+
+# LIKE 'prefix%' only uses a varchar_pattern_ops index on PostgreSQL (with a non-C collation); elsewhere the unique name index serves it
+NAME_PATTERN_INDEX = DDL('CREATE INDEX IF NOT EXISTS ix_items_name_pattern ON items (name varchar_pattern_ops)')
+
+
+class VersionConflict(Exception):
+    pass
+
+
+def on_conflict_insert(session, table):
+    """
+    :return: An INSERT supporting on_conflict_do_nothing/on_conflict_do_update on PostgreSQL and SQLite, None on other databases.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+    return dialect_insert(table)
 
 
 class ItemModel(db.Model):
     __tablename__ = 'items'
+    __table_args__ = (
+        db.Index('ix_items_price_id', 'price', 'id'), # price range search and sort=price pages
+        db.Index('ix_items_store_id_price', 'store_id', 'price'), # a store's items, also within a price range
+    ) # and NAME_PATTERN_INDEX on PostgreSQL
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(80))
+    name = db.Column(db.String(80), unique=True, index=True) # every /item/<name> request looks items up by name
     price = db.Column(db.Float(precision=2))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1') # bumped by every update, see upsert
 
-    store_id = db.Column(db.Integer, db.ForeignKey('stores.id'))
+    store_id = db.Column(db.Integer, db.ForeignKey('stores.id')) # indexed by ix_items_store_id_price
     store = db.relationship('StoreModel', back_populates = 'items')
 
+    __mapper_args__ = {'version_id_col': version} # ORM updates check and bump the version too
+
     def __init__(self, name, price, store_id):
         self.name = name
         self.price = price
         self.store_id = store_id
 
+    change_type = 'item' # see models.change
+
     def json(self):
         return {'name': self.name, 'price': self.price}
 
+    def change_data(self):
+        return {'name': self.name, 'price': self.price, 'store_id': self.store_id}
+
+    @staticmethod
+    def etag(payload, version):
+        """
+        The ETag of an item: its version, so If-Match can be checked by the UPDATE itself, and a hash of its json(),
+        so a deleted and recreated item doesn't look unchanged.
+        """
+        return '{}-{}'.format(version, make_etag(payload))
+
+    @staticmethod
+    def version_from_etag(etag):
+        """
+        :return: The version in an ETag built by etag(), None if it isn't one.
+        """
+        version, _, digest = etag.partition('-')
+        return int(version) if version.isdigit() and digest else None
+
     @classmethod
     def find_by_name(cls, name):
         return cls.query.filter_by(name=name).first()
 
+    @classmethod
+    def search_filters(cls, prefix=None, min_price=None, max_price=None, store_id=None):
+        """
+        The conditions on the items matching every given filter.
+        :param prefix: The names must start with it (case-sensitive).
+        :param min_price: The lowest price, inclusive.
+        :param max_price: The highest price, inclusive.
+        :param store_id: Only the items of this store.
+        :return: A list of SQL expressions, for Query.filter or select().where.
+        """
+        filters = []
+        if prefix:
+            # the range lets the name index do the work on every database, LIKE keeps the match exact
+            filters += [cls.name >= prefix, cls.name.startswith(prefix, autoescape=True)]
+            if ord(prefix[-1]) < sys.maxunicode: # nothing sorts after U+10FFFF, there is no upper bound then
+                filters.append(cls.name < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        if min_price is not None:
+            filters.append(cls.price >= min_price)
+        if max_price is not None:
+            filters.append(cls.price <= max_price)
+        if store_id is not None:
+            filters.append(cls.store_id == store_id)
+        return filters
+
+    @classmethod
+    def search(cls, prefix=None, min_price=None, max_price=None, store_id=None):
+        """
+        :return: The query for the items matching every given filter (see search_filters), still to be ordered and paginated.
+        """
+        return cls.query.filter(*cls.search_filters(prefix, min_price, max_price, store_id))
+
+    @classmethod
+    def record_columns(cls):
+        return cls.id, cls.name, cls.price, cls.store_id
+
+    @classmethod
+    def records(cls, *filters):
+        """
+        The read-only alternative to cls.query for list endpoints: selects just the columns json() needs
+        (and the keys to page on) into compact named tuples, so no ItemModel instance, identity map entry
+        or attribute state is created per row.
+        :param filters: Conditions on the items, e.g. search_filters().
+        :return: A query of rows with id, name, price and store_id.
+        """
+        return db.session.query(*cls.record_columns()).filter(*filters)
+
+    @staticmethod
+    def record_json(record):
+        """
+        json() for a row of records().
+        """
+        return {'name': record.name, 'price': record.price}
+
+    @classmethod
+    def cache_key(cls, name):
+        return 'item:' + name
+
+    def cache_keys(self):
+        """
+        The cached responses which contain this item: its own and its store's.
+        """
+        keys = [self.cache_key(self.name)]
+        if self.store:
+            keys.extend(self.store.cache_keys(self.store.name))
+        return keys
+
     def save_to_db(self):
-        db.session.add(self)
-        db.session.commit()
+        response_cache.invalidate(*committer.save(self, ItemModel.cache_keys))
+
+    @classmethod
+    def store_cache_keys(cls, store_ids, session=db.session):
+        """
+        The cached responses of the stores with these ids (see StoreModel.cache_keys).
+        """
+        from models.store import StoreModel # models.store imports this module
+
+        store_names = session.query(StoreModel.name).filter(StoreModel.id.in_(store_ids))
+        return [key for name, in store_names for key in StoreModel.cache_keys(name)]
+
+    @classmethod
+    def insert_statements(cls, session, name, price, store_id):
+        """
+        The statements of insert() in the transaction of session, not committed (the ASGI app runs them too).
+        :return: The cache keys to invalidate after the commit, None if an item with this name already exists.
+        :raises IntegrityError: The name is taken, on databases without ON CONFLICT.
+        """
+        values = {'name': name, 'price': price, 'store_id': store_id, 'version': 1}
+        statement = on_conflict_insert(session, cls.__table__)
+        if statement is None:
+            session.execute(insert(cls.__table__).values(**values))
+        elif session.execute(statement.values(**values).on_conflict_do_nothing(index_elements=['name'])).rowcount == 0:
+            return None
+        ChangeModel.log(session, [('item', name, {'name': name, 'price': price, 'store_id': store_id})])
+        return [cls.cache_key(name)] + cls.store_cache_keys([store_id], session)
+
+    @classmethod
+    def insert(cls, name, price, store_id):
+        """
+        Creates an item in a single statement, without looking it up first: INSERT ... ON CONFLICT DO NOTHING
+        where the database supports it, a plain INSERT failing on the unique name otherwise.
+        :return: True if the item was created, False if an item with this name already exists.
+        """
+        try:
+            keys = committer.run(lambda session: cls.insert_statements(session, name, price, store_id))
+        except IntegrityError:
+            if on_conflict_insert(db.session(), cls.__table__) is not None:
+                raise # the name conflict is handled by ON CONFLICT, this is another constraint
+            return False
+        if keys is None:
+            return False
+        response_cache.invalidate(*keys)
+        return True
+
+    @classmethod
+    def upsert_statements(cls, session, name, price, store_id, expected_version=None, create=True):
+        """
+        The statements of upsert() in the transaction of session, not committed (the ASGI app runs them too).
+        :return: A tuple (version of the item after the write, cache keys to invalidate after the commit).
+        :raises VersionConflict: The item doesn't exist (anymore) or has another version.
+        """
+        table = cls.__table__
+        condition = [table.c.name == name]
+        if expected_version is not None:
+            condition.append(table.c.version == expected_version)
+        changes = {'price': price, 'version': table.c.version + 1}
+
+        statement = on_conflict_insert(session, table) if create and expected_version is None else None
+        if statement is not None:
+            statement = statement.values(name=name, price=price, store_id=store_id, version=1)
+            session.execute(statement.on_conflict_do_update(index_elements=['name'], set_=changes))
+        elif session.execute(update(table).where(*condition).values(**changes)).rowcount == 0:
+            if not create or expected_version is not None:
+                raise VersionConflict("Item '{}' doesn't have version {}.".format(name, expected_version))
+            session.execute(insert(table).values(name=name, price=price, store_id=store_id, version=1))
+        item_store_id, version = session.query(cls.store_id, cls.version).filter(cls.name == name).one() # same transaction, sees our write
+        ChangeModel.log(session, [('item', name, {'name': name, 'price': price, 'store_id': item_store_id})])
+        return version, [cls.cache_key(name)] + cls.store_cache_keys([item_store_id], session)
+
+    @classmethod
+    def upsert(cls, name, price, store_id, expected_version=None, create=True):
+        """
+        Creates the item or updates its price (like PUT /item/<name>) atomically, so concurrent writers can't
+        create duplicates or lose updates: INSERT ... ON CONFLICT DO UPDATE on PostgreSQL and SQLite,
+        UPDATE then INSERT on other databases.
+        :param expected_version: Only update the item if it still has this version (If-Match), never create it.
+        :param create: False to only update an existing item (If-Match: *).
+        :return: The version of the item after the write.
+        :raises VersionConflict: The item doesn't exist (anymore) or has another version.
+        """
+        version, keys = committer.run(lambda session: cls.upsert_statements(session, name, price, store_id, expected_version, create))
+        response_cache.invalidate(*keys)
+        return version
+
+    @classmethod
+    def bulk_upsert(cls, rows, chunk_size=BULK_CHUNK_SIZE):
+        """
+        Creates or updates (the price of, like PUT /item/<name>) many items at once:
+        per chunk, one IN query finds the existing items, then bulk inserts/updates run in one transaction.
+        :param rows: A list of dictionaries with name, price and store_id; names must be unique.
+        :param chunk_size: How many rows go in one transaction.
+        :return: A list with 'created', 'updated' or 'error' (the whole chunk was rolled back) for every row, in the same order.
+        """
+        outcomes = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            try:
+                existing, keys = cls.bulk_upsert_statements(db.session(), chunk)
+                db.session.commit()
+            except:
+                db.session.rollback()
+                outcomes.extend('error' for row in chunk)
+                continue
+            response_cache.invalidate(*keys)
+            outcomes.extend('updated' if row['name'] in existing else 'created' for row in chunk)
+        return outcomes
+
+    @classmethod
+    def bulk_upsert_statements(cls, session, rows):
+        """
+        The statements of one bulk_upsert() chunk in the transaction of session, not committed (the ASGI app runs them too).
+        The updates are SQL statements, so a concurrent write can't fail the version check of an ORM flush.
+        :return: A tuple (names of the items which already existed, cache keys to invalidate after the commit).
+        """
+        existing = {name: (id, store_id) for name, id, store_id in
+                    session.query(cls.name, cls.id, cls.store_id).filter(cls.name.in_([row['name'] for row in rows]))}
+        inserts = [row for row in rows if row['name'] not in existing]
+        updates = [{'item_id': existing[row['name']][0], 'price': row['price']} for row in rows if row['name'] in existing]
+        store_ids = {row['store_id'] for row in inserts} | {store_id for id, store_id in existing.values()}
+        session.bulk_insert_mappings(cls, inserts)
+        if updates: # one executemany bumping the versions, which bulk_update_mappings doesn't do
+            session.execute(update(cls.__table__).where(cls.__table__.c.id == bindparam('item_id'))
+                            .values(price=bindparam('price'), version=cls.__table__.c.version + 1), updates)
+        ChangeModel.log(session, [('item', row['name'], {'name': row['name'], 'price': row['price'],
+                                                        'store_id': existing[row['name']][1] if row['name'] in existing else row['store_id']})
+                                  for row in rows]) # bulk and SQL writes skip the before_flush listener
+        return set(existing), [cls.cache_key(row['name']) for row in rows] + cls.store_cache_keys(store_ids, session)
+
+    @classmethod
+    def delete_statements(cls, session, name):
+        """
+        The statements of delete_by_name() in the transaction of session, not committed (the ASGI app runs them too).
+        :return: The cache keys to invalidate after the commit, None if there was no such item.
+        """
+        store_ids = [store_id for store_id, in session.query(cls.store_id).filter(cls.name == name)]
+        if session.execute(delete(cls.__table__).where(cls.__table__.c.name == name)).rowcount == 0:
+            return None
+        ChangeModel.log(session, [('item', name, None)])
+        return [cls.cache_key(name)] + cls.store_cache_keys(store_ids, session)
+
+    @classmethod
+    def delete_by_name(cls, name):
+        """
+        Deletes the item in a single DELETE by name, whatever its version, so a delete racing an update
+        can't fail the version check of an ORM delete.
+        :return: True if the item was deleted, False if there was none.
+        """
+        keys = committer.run(lambda session: cls.delete_statements(session, name))
+        if keys is None:
+            return False
+        response_cache.invalidate(*keys)
+        return True
 
     def delete_from_db(self):
-        db.session.delete(self)
-        db.session.commit()
+        response_cache.invalidate(*committer.delete(self, ItemModel.cache_keys))
+
+
+event.listen(ItemModel.__table__, 'after_create', NAME_PATTERN_INDEX.execute_if(dialect='postgresql'))
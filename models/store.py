@@ -1,4 +1,9 @@
+from cache import response_cache
+from committer import committer
+from sqlalchemy import func
+
 from db import db
+from models.item import ItemModel
 
 
 class StoreModel(db.Model):
@@ -8,7 +13,7 @@ class StoreModel(db.Model):
     # one per column in the row that belongs to this instance.
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(80))
+    name = db.Column(db.String(80), unique=True, index=True)
 
     items = db.relationship('ItemModel', lazy='dynamic', back_populates = 'store') # if we remove lazy, items will fetch all items automatically ->
                                                         # when you create object; if we leave lazy, items will fetch by function all()
@@ -16,17 +21,93 @@ class StoreModel(db.Model):
     def __init__(self, name):
         self.name = name
 
+    change_type = 'store' # see models.change
+
     def json(self):
         return {'name': self.name, 'items': [item.json() for item in self.items.all()]} # not unit test because of self.items( using database)
 
+    def change_data(self):
+        return {'name': self.name}
+
+    def item_records(self):
+        """
+        The items of the store as ItemModel.records() rows: the dynamic items query, so it can still be filtered and sliced.
+        """
+        return self.items.with_entities(*ItemModel.record_columns())
+
+    @classmethod
+    def json_many(cls, stores):
+        """
+        Serializes many stores with their items using one query for all the items,
+        instead of one self.items query per store.
+        :param stores: A list of StoreModel objects, or of rows of records().
+        :return: A list of dictionaries in the same format as json().
+        """
+        items_by_store = {store.id: [] for store in stores}
+        if items_by_store:
+            items = ItemModel.records(ItemModel.store_id.in_(items_by_store.keys())).order_by(ItemModel.id)
+            for item in items:
+                items_by_store[item.store_id].append(ItemModel.record_json(item))
+        return [{'name': store.name, 'items': items_by_store[store.id]} for store in stores]
+
+    @classmethod
+    def record_columns(cls):
+        return cls.id, cls.name
+
+    @classmethod
+    def records(cls):
+        """
+        Like ItemModel.records: the stores as (id, name) rows instead of StoreModel instances.
+        """
+        return db.session.query(*cls.record_columns())
+
     @classmethod
     def find_by_name(cls, name):
         return cls.query.filter_by(name=name).first()
 
+    @classmethod
+    def cache_key(cls, name, items='all'):
+        """
+        :param items: How the response shows the items, see resources.store.Store.
+        """
+        return 'store:' + name if items == 'all' else 'store:{}?items={}'.format(name, items)
+
+    @classmethod
+    def summary_cache_key(cls, name=None):
+        return 'summary:store:' + name if name is not None else 'summary:stores'
+
+    @classmethod
+    def cache_keys(cls, name):
+        """
+        The cached responses which depend on the store or its items: the store (with its items, their count or none),
+        its summary and all the summaries.
+        """
+        return [cls.cache_key(name), cls.cache_key(name, 'count'), cls.cache_key(name, 'none'),
+                cls.summary_cache_key(name), cls.summary_cache_key()]
+
+    @classmethod
+    def summaries(cls, name=None):
+        """
+        Item count and min/max/average price per store, computed by the database
+        in a single GROUP BY query instead of loading the items.
+        :param name: Only summarize this store.
+        :return: A list of dictionaries, ordered by store id.
+        """
+        query = db.session.query(cls.name,
+                                 func.count(ItemModel.id),
+                                 func.min(ItemModel.price),
+                                 func.max(ItemModel.price),
+                                 func.avg(ItemModel.price)).outerjoin(ItemModel, ItemModel.store_id == cls.id)
+        if name is not None:
+            query = query.filter(cls.name == name)
+        query = query.group_by(cls.id, cls.name).order_by(cls.id)
+        return [{'name': store_name, 'item_count': count, 'min_price': min_price, 'max_price': max_price, 'avg_price': avg_price}
+                for store_name, count, min_price, max_price, avg_price in query]
+
     def save_to_db(self):
-        db.session.add(self)
-        db.session.commit()
+        committer.save(self)
+        response_cache.invalidate(*self.cache_keys(self.name))
 
     def delete_from_db(self):
-        db.session.delete(self)
-        db.session.commit()
+        committer.delete(self)
+        response_cache.invalidate(*self.cache_keys(self.name))
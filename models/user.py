@@ -1,10 +1,20 @@
+import os
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from cache import TTLCache
+from committer import committer
 from db import db
 
+# users loaded by security.identity, keyed by user id
+identity_cache = TTLCache(maxsize=int(os.environ.get('IDENTITY_CACHE_SIZE', 1024)),
+                          ttl=float(os.environ.get('IDENTITY_CACHE_TTL', 60)))
+
 class UserModel(db.Model):
     __tablename__ = 'users'
 
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80))
+    username = db.Column(db.String(80), unique=True, index=True)
     password = db.Column(db.String())
 
     def __init__(self, username, password):
@@ -13,8 +23,18 @@ class UserModel(db.Model):
 
 
     def save_to_db(self):
-        db.session.add(self)
-        db.session.commit()
+        committer.save(self)
+        identity_cache.delete(self.id)
+
+    def detached_copy(self):
+        """
+        A copy of the user which doesn't belong to any session,
+        so it can be kept in identity_cache and shared between requests.
+        """
+        user = UserModel(self.username, self.password)
+        user.id = self.id
+        make_transient_to_detached(user)
+        return user
 
 
     @classmethod
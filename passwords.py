@@ -0,0 +1,96 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache
+
+# cost is the number of iterations for pbkdf2_sha256 and log2(N) for scrypt
+DEFAULT_COSTS = {'pbkdf2_sha256': 600000, 'scrypt': 14}
+
+ALGORITHM = os.environ.get('PASSWORD_HASH_ALGORITHM', 'pbkdf2_sha256')
+COST = int(os.environ.get('PASSWORD_HASH_COST', DEFAULT_COSTS[ALGORITHM]))
+
+# hashing releases the GIL, so a few threads keep the KDF work off the request threads without starving them of CPU
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)),
+                               thread_name_prefix='password-hash')
+
+# successful verifications, so repeated logins skip the KDF; keys are keyed hashes, never the password itself
+_verified = TTLCache(maxsize=int(os.environ.get('PASSWORD_CACHE_SIZE', 1024)),
+                     ttl=float(os.environ.get('PASSWORD_CACHE_TTL', 300)))
+_verified_key = secrets.token_bytes(32)
+
+
+def _derive(algorithm, cost, password, salt):
+    if algorithm == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, cost)
+    if algorithm == 'scrypt':
+        return hashlib.scrypt(password.encode(), salt=salt, n=2 ** cost, r=8, p=1, maxmem=2 ** (cost + 11))
+    raise ValueError("Unknown password hash algorithm '{}'.".format(algorithm))
+
+
+def _encode(algorithm, cost, salt, digest):
+    return '${}${}${}${}'.format(algorithm, cost, base64.b64encode(salt).decode(), base64.b64encode(digest).decode())
+
+
+def _parse(stored):
+    """
+    :return: A tuple (algorithm, cost, salt, digest), or None for a legacy plaintext password.
+    """
+    parts = stored.split('$')
+    if len(parts) != 5 or parts[0] or parts[1] not in DEFAULT_COSTS:
+        return None
+    try:
+        return parts[1], int(parts[2]), base64.b64decode(parts[3]), base64.b64decode(parts[4])
+    except ValueError:
+        return None
+
+
+def _hash(password, algorithm, cost):
+    salt = secrets.token_bytes(16)
+    return _encode(algorithm, cost, salt, _derive(algorithm, cost, password, salt))
+
+
+def _verify(password, stored):
+    parsed = _parse(stored)
+    if parsed is None: # a row from before passwords were hashed
+        return hmac.compare_digest(stored.encode(), password.encode())
+    algorithm, cost, salt, digest = parsed
+    return hmac.compare_digest(_derive(algorithm, cost, password, salt), digest)
+
+
+def hash_password(password, algorithm=None, cost=None):
+    """
+    Hashes a password with a random salt, in the hashing thread pool.
+    :param password: The password in string format.
+    :param algorithm: 'pbkdf2_sha256' or 'scrypt', PASSWORD_HASH_ALGORITHM by default.
+    :param cost: The work factor of the algorithm, PASSWORD_HASH_COST by default.
+    :return: A string like $algorithm$cost$salt$hash, fit for UserModel.password.
+    """
+    return _executor.submit(_hash, password, algorithm or ALGORITHM, cost or COST).result()
+
+
+def verify_password(password, stored):
+    """
+    Checks a password against what is stored for the user, hashed or legacy plaintext.
+    :param password: The password the user sent, in string format.
+    :param stored: The value of UserModel.password.
+    :return: True if the password matches.
+    """
+    key = hmac.new(_verified_key, '{}\0{}'.format(stored, password).encode(), hashlib.sha256).digest()
+    if _verified.get(key):
+        return True
+    verified = _executor.submit(_verify, password, stored).result()
+    if verified:
+        _verified.set(key, True)
+    return verified
+
+
+def needs_rehash(stored):
+    """
+    :return: True if the stored password is plaintext or hashed with other settings than the configured ones.
+    """
+    parsed = _parse(stored)
+    return parsed is None or parsed[:2] != (ALGORITHM, COST)
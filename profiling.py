@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import Histogram
+from serializers import serializer
+
+logger = logging.getLogger(__name__)
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestProfile:
+    """
+    What one request cost: SQL statements, time spent in the database and
+    serializing the response, and the slowest statement.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.slowest = (0.0, None) # (seconds, statement)
+
+    def record_query(self, statement, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+        if seconds > self.slowest[0]:
+            self.slowest = (seconds, statement)
+
+
+class EndpointProfile:
+    def __init__(self):
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.db_seconds = Histogram()
+        self.serialize_seconds = Histogram()
+        self.total_seconds = Histogram()
+        self.slowest = (0.0, None)
+
+    def snapshot(self):
+        return {'queries': self.queries.snapshot(),
+                'db_seconds': self.db_seconds.snapshot(),
+                'serialize_seconds': self.serialize_seconds.snapshot(),
+                'total_seconds': self.total_seconds.snapshot(),
+                'slowest_query': {'seconds': self.slowest[0], 'statement': self.slowest[1]}}
+
+
+class Profiler:
+    """
+    Counts the SQL statements of every request (X-Query-Count header). With the PROFILE_REQUESTS setting it also
+    times them and the JSON serialization, adds a Server-Timing header, aggregates histograms per endpoint
+    and checks QUERY_BUDGETS ({'METHOD endpoint': max statements}), raising QueryBudgetExceeded
+    when QUERY_BUDGET_STRICT is set and logging a warning otherwise.
+    Statements slower than SLOW_QUERY_SECONDS are logged.
+    """
+    def __init__(self):
+        self.endpoints = {} # 'METHOD endpoint' -> EndpointProfile
+        self._lock = threading.Lock()
+        self._budgets = threading.local() # counters of the query_budget blocks running in this thread
+
+    def init_app(self, app):
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.listen(Engine, 'handle_error', self.handle_error)
+
+    # database events
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        for budget in getattr(self._budgets, 'stack', []):
+            budget['queries'] += 1
+        if not has_app_context():
+            return
+        profile = g.get('profile')
+        if profile is not None:
+            profile.record_query(statement, seconds)
+        slow_query_seconds = current_app.config.get('SLOW_QUERY_SECONDS')
+        if slow_query_seconds is not None and seconds >= slow_query_seconds:
+            logger.warning("Slow query (%.3fs): %s", seconds, statement)
+
+    def handle_error(self, context):
+        if context.connection is not None and context.connection.info.get('query_start'):
+            context.connection.info['query_start'].pop()
+
+    # request lifecycle
+
+    def start_request(self):
+        g.profile = RequestProfile()
+
+    def serialize(self, data, code, headers=None):
+        """
+        The JSON representation of the serializer, timed.
+        """
+        start = time.perf_counter()
+        response = serializer.output_json(data, code, headers)
+        profile = g.get('profile')
+        if profile is not None:
+            profile.serialize_seconds += time.perf_counter() - start
+        return response
+
+    def finish_request(self, response):
+        profile = g.get('profile')
+        if profile is None:
+            return response
+        name = '{} {}'.format(request.method, request.endpoint)
+        if response.is_streamed:
+            # the body runs its queries after the headers are sent (e.g. /items/export), so there are no headers:
+            # the profile stays in g to count them and goes to the histograms when the stream is closed
+            if current_app.config.get('PROFILE_REQUESTS'):
+                budget = current_app.config.get('QUERY_BUDGETS', {}).get(name)
+                response.call_on_close(lambda: self.observe(name, profile, budget))
+            return response
+
+        g.pop('profile')
+        response.headers['X-Query-Count'] = str(profile.queries)
+        if not current_app.config.get('PROFILE_REQUESTS'):
+            return response
+
+        total_seconds = self.observe(name, profile)
+        response.headers['Server-Timing'] = 'db;dur={:.2f};desc="{} queries", serialize;dur={:.2f}, total;dur={:.2f}'.format(
+            profile.db_seconds * 1000, profile.queries, profile.serialize_seconds * 1000, total_seconds * 1000)
+
+        budget = current_app.config.get('QUERY_BUDGETS', {}).get(name)
+        if budget is not None and profile.queries > budget:
+            message = "{} ran {} queries, its budget is {}".format(name, profile.queries, budget)
+            if current_app.config.get('QUERY_BUDGET_STRICT'):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+    def observe(self, name, profile, budget=None):
+        """
+        Adds a finished request to the histograms of its endpoint.
+        :param budget: Log a warning if the request ran more queries; for streamed responses, which can't fail anymore.
+        :return: The total seconds of the request.
+        """
+        total_seconds = time.perf_counter() - profile.start
+        with self._lock:
+            endpoint = self.endpoints.setdefault(name, EndpointProfile())
+            if profile.slowest[0] > endpoint.slowest[0]:
+                endpoint.slowest = profile.slowest
+        endpoint.queries.observe(profile.queries)
+        endpoint.db_seconds.observe(profile.db_seconds)
+        endpoint.serialize_seconds.observe(profile.serialize_seconds)
+        endpoint.total_seconds.observe(total_seconds)
+        if budget is not None and profile.queries > budget:
+            logger.warning("%s ran %s queries, its budget is %s", name, profile.queries, budget)
+        return total_seconds
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = dict(self.endpoints)
+        return {name: endpoint.snapshot() for name, endpoint in endpoints.items()}
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+
+    @contextmanager
+    def query_budget(self, max_queries):
+        """
+        Fails the block (e.g. a test) if it sends more than max_queries statements to the database:
+
+            with profiler.query_budget(2):
+                client.get('/stores')
+        """
+        budget = {'queries': 0}
+        stack = self._budgets.__dict__.setdefault('stack', [])
+        stack.append(budget)
+        try:
+            yield budget
+        finally:
+            stack.remove(budget)
+        if budget['queries'] > max_queries:
+            raise QueryBudgetExceeded("{} queries ran, the budget is {}".format(budget['queries'], max_queries))
+
+
+profiler = Profiler()
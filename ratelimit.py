@@ -0,0 +1,169 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+import jwt
+from flask import current_app, jsonify, request
+from flask_jwt import _jwt
+
+from cache import TTLCache
+
+
+def parse_limit(value):
+    """
+    Parses one limit, 'rate:burst': the requests per second a client may send on average and how many it may send at once.
+    :return: A tuple (rate, burst), burst defaulting to rate.
+    :raises ValueError: The rate isn't positive or the burst is below one request, no request could ever pass.
+    """
+    rate, _, burst = value.partition(':')
+    rate, burst = float(rate), float(burst or rate)
+    if rate <= 0 or burst < 1:
+        raise ValueError("Invalid rate limit '{}': the rate must be positive and the burst at least 1.".format(value))
+    return rate, burst
+
+
+def parse_limits(value):
+    """
+    Parses RATE_LIMITS, e.g. 'GET itemlist=50:100,POST auth=1:5' (see parse_limit), per 'METHOD endpoint'.
+    :return: A dictionary {'METHOD endpoint': (rate, burst)}.
+    """
+    limits = {}
+    for rule in filter(None, (rule.strip() for rule in value.split(','))):
+        route, _, limit = rule.rpartition('=')
+        limits[route.strip()] = parse_limit(limit)
+    return limits
+
+
+def take_token(tokens, updated, rate, burst, now):
+    """
+    One request against a token bucket, refilled with rate tokens per second up to burst.
+    :return: A tuple (allowed, tokens left, seconds until a token is available).
+    """
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return True, tokens - 1, 0.0
+    return False, tokens, (1 - tokens) / rate
+
+
+class MemoryBuckets:
+    """
+    The token buckets of one process. Idle buckets are dropped after an hour; they are full again by then anyway.
+    """
+    def __init__(self, maxsize=100000, timer=time.time):
+        self.buckets = TTLCache(maxsize=maxsize, ttl=3600, timer=timer)
+        self.timer = timer
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        with self._lock:
+            now = self.timer()
+            tokens, updated = self.buckets.get(key, (burst, now))
+            allowed, tokens, retry_after = take_token(tokens, updated, rate, burst, now)
+            self.buckets.set(key, (tokens, now))
+        return allowed, retry_after
+
+
+class SharedBuckets:
+    """
+    Token buckets shared by the worker processes of one machine: a fixed table of (key hash, tokens, updated)
+    slots in a memory mapped file, locked with flock. Two keys landing in the same slot share a bucket
+    only until the next one takes it over, which at worst resets a bucket.
+    """
+    SLOT = struct.Struct('<Qdd')
+
+    def __init__(self, path, slots=65536, timer=time.time):
+        self.slots = slots
+        self.timer = timer
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < slots * self.SLOT.size:
+            os.ftruncate(self.fd, slots * self.SLOT.size)
+        self.memory = mmap.mmap(self.fd, slots * self.SLOT.size)
+        self._lock = threading.Lock() # flock is per process, threads queue up here first
+
+    def take(self, key, rate, burst):
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') # the same in every process
+        offset = digest % self.slots * self.SLOT.size
+        with self._lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                now = self.timer()
+                slot_digest, tokens, updated = self.SLOT.unpack_from(self.memory, offset)
+                if slot_digest != digest:
+                    tokens, updated = burst, now
+                allowed, tokens, retry_after = take_token(tokens, updated, rate, burst, now)
+                self.SLOT.pack_into(self.memory, offset, digest, tokens, now)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return allowed, retry_after
+
+
+class RateLimiter:
+    """
+    Admission control in front of every request:
+    MAX_CONCURRENT_REQUESTS caps the requests in progress in this process, answering 503 beyond it,
+    so a burst is shed before it queues up on the database pool; RATE_LIMITS (see parse_limits) and
+    RATE_LIMIT_DEFAULT give every client a token bucket per route, answering 429 when it is empty.
+    Clients are told apart by the identity in their JWT, or by address without a valid token.
+    Both answers carry Retry-After.
+    """
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBuckets()
+        self.limits = {}
+        self.default_limit = None
+        self.max_concurrent = None
+        self.exempt = {'metrics', 'poolstats', 'profilestats'} # monitoring keeps working under load
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.limits = app.config.get('RATE_LIMITS', {})
+        self.default_limit = app.config.get('RATE_LIMIT_DEFAULT')
+        self.max_concurrent = app.config.get('MAX_CONCURRENT_REQUESTS')
+        app.before_request(self.start_request)
+        app.teardown_request(self.finish_request)
+
+    def client_key(self):
+        token = request.headers.get('Authorization', '').split()
+        if len(token) == 2 and token[0].lower() == current_app.config['JWT_AUTH_HEADER_PREFIX'].lower():
+            try:
+                return 'identity:{}'.format(_jwt.jwt_decode_callback(token[1])['identity'])
+            except (jwt.InvalidTokenError, KeyError):
+                pass
+        return 'address:{}'.format(request.remote_addr)
+
+    def reject(self, status, message, retry_after):
+        response = jsonify({'message': message})
+        response.status_code = status
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+    def start_request(self):
+        if request.endpoint in self.exempt:
+            return None
+        if self.max_concurrent is not None:
+            with self._lock:
+                if self.in_flight >= self.max_concurrent:
+                    return self.reject(503, 'The server is busy, please retry later.', 1)
+                self.in_flight += 1
+                request.environ['ratelimit.admitted'] = True # not g: teardown_request may run after the app context is gone
+
+        route = '{} {}'.format(request.method, request.endpoint)
+        limit = self.limits.get(route, self.default_limit)
+        if limit is not None:
+            allowed, retry_after = self.backend.take('{}|{}'.format(route, self.client_key()), *limit)
+            if not allowed:
+                return self.reject(429, 'Too many requests, please slow down.', retry_after)
+        return None
+
+    def finish_request(self, exception=None):
+        if request.environ.pop('ratelimit.admitted', False):
+            with self._lock:
+                self.in_flight -= 1
+
+
+rate_limiter = RateLimiter()
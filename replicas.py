@@ -0,0 +1,129 @@
+import itertools
+import math
+import os
+import threading
+import time
+
+from flask import g, request
+from sqlalchemy import create_engine, event, text
+
+from cache import TTLCache
+from db import engine_options
+
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+STICKY_COOKIE = 'read_primary' # set on a write, expires after REPLICA_STICKY_SECONDS
+
+
+class ReplicaRouter:
+    """
+    Sends the queries of read-only requests (GET, HEAD) to the read replicas of REPLICA_DATABASE_URIS,
+    picked round-robin or least-loaded (fewest connections in use, REPLICA_SELECTION).
+    After a write, the same client reads from the primary for REPLICA_STICKY_SECONDS so it sees its own changes
+    despite the replication lag. The response sets a cookie saying so, which every worker honours, whatever
+    the client authenticates with next (e.g. right after /register); clients ignoring cookies are remembered
+    by their Authorization header, or address, in this process only.
+    A replica failing to connect is skipped for REPLICA_RETRY_SECONDS, then pinged before it gets traffic again;
+    without a healthy replica everything goes to the primary.
+    """
+    def __init__(self):
+        self.engines = []
+        self.selection = 'round_robin'
+        self.retry_seconds = 30
+        self.in_use = {} # engine -> connections checked out
+        self.down_until = {} # engine -> time.monotonic() before which it isn't used
+        self.sticky = TTLCache(maxsize=10000, ttl=5)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        self.configure(app.config.get('REPLICA_DATABASE_URIS', []),
+                       app.config.get('REPLICA_SELECTION', self.selection),
+                       app.config.get('REPLICA_STICKY_SECONDS', self.sticky.ttl),
+                       app.config.get('REPLICA_RETRY_SECONDS', self.retry_seconds))
+
+    def configure(self, uris, selection='round_robin', sticky_seconds=5, retry_seconds=30):
+        """
+        (Re)creates the replica engines, with the same DB_POOL_* settings as the primary.
+        """
+        if selection not in ('round_robin', 'least_loaded'):
+            raise ValueError("REPLICA_SELECTION must be round_robin or least_loaded, not '{}'.".format(selection))
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = [create_engine(uri, **engine_options(uri, os.environ)) for uri in uris]
+        self.selection = selection
+        self.retry_seconds = retry_seconds
+        self.in_use = {engine: 0 for engine in self.engines}
+        self.down_until = {}
+        self.sticky = TTLCache(maxsize=10000, ttl=sticky_seconds)
+        for engine in self.engines:
+            event.listen(engine, 'checkout', lambda *args, engine=engine: self._count(engine, 1))
+            event.listen(engine, 'checkin', lambda *args, engine=engine: self._count(engine, -1))
+            event.listen(engine, 'handle_error', lambda context, engine=engine: self._handle_error(engine, context))
+
+    # request lifecycle
+
+    def client_key(self):
+        return request.headers.get('Authorization') or request.remote_addr
+
+    def start_request(self):
+        if self.engines and request.method in READ_ONLY_METHODS and not self.is_sticky():
+            g.replica = self.choose()
+        else:
+            g.replica = None # g outlives the request when the app context was pushed before it, e.g. in tests
+
+    def is_sticky(self):
+        return STICKY_COOKIE in request.cookies or self.sticky.get(self.client_key()) is not None
+
+    def lag(self):
+        """
+        :return: How many seconds the data this request reads may be behind the primary: REPLICA_STICKY_SECONDS on a replica, 0 on the primary.
+        """
+        return self.sticky.ttl if g.get('replica') is not None else 0
+
+    def finish_request(self, response):
+        if self.engines and request.method not in READ_ONLY_METHODS and response.status_code < 400:
+            self.sticky.set(self.client_key(), True) # read your writes: the primary for a while
+            response.set_cookie(STICKY_COOKIE, '1', max_age=math.ceil(self.sticky.ttl), httponly=True)
+        return response
+
+    # selection
+
+    def choose(self):
+        """
+        :return: The replica engine for the next read-only request, None to use the primary.
+        """
+        healthy = [engine for engine in self.engines if self.is_healthy(engine)]
+        if not healthy:
+            return None
+        if self.selection == 'least_loaded':
+            with self._lock:
+                return min(healthy, key=lambda engine: self.in_use[engine])
+        return healthy[next(self._counter) % len(healthy)]
+
+    def is_healthy(self, engine):
+        down_until = self.down_until.get(engine)
+        if down_until is None:
+            return True
+        if time.monotonic() < down_until:
+            return False
+        try: # the retry delay is over, check it works before sending requests to it
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except Exception:
+            self.down_until[engine] = time.monotonic() + self.retry_seconds
+            return False
+        self.down_until.pop(engine, None)
+        return True
+
+    def _count(self, engine, delta):
+        with self._lock:
+            self.in_use[engine] = self.in_use.get(engine, 0) + delta
+
+    def _handle_error(self, engine, context):
+        if context.is_disconnect or context.connection is None: # lost or couldn't open a connection
+            self.down_until[engine] = time.monotonic() + self.retry_seconds
+
+
+replica_router = ReplicaRouter()
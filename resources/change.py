@@ -0,0 +1,66 @@
+import time
+
+from flask_restful import Resource, inputs, reqparse
+
+from db import db
+from models.change import ChangeModel, change_feed
+from resources.pagination import DEFAULT_LIMIT, MAX_LIMIT, decode_cursor, encode_cursor
+
+MAX_WAIT = 30 # seconds a long poll may wait, below the usual proxy timeouts
+POLL_SECONDS = 1 # how often a long poll looks for the commits of other processes
+
+
+def wait_seconds(value):
+    """
+    The wait argument: a number of seconds from 0 to MAX_WAIT (which also keeps out nan and inf).
+    """
+    seconds = float(value)
+    if not 0 <= seconds <= MAX_WAIT:
+        raise ValueError("{} is not between 0 and {}.".format(value, MAX_WAIT))
+    return seconds
+
+
+change_parser = reqparse.RequestParser()
+change_parser.add_argument('since',
+                           location='args',
+                           help="since must be the 'next' or 'last' of a previous response.")
+change_parser.add_argument('limit',
+                           type=inputs.int_range(1, MAX_LIMIT),
+                           location='args',
+                           default=DEFAULT_LIMIT,
+                           help="limit must be between 1 and {}.".format(MAX_LIMIT))
+change_parser.add_argument('wait',
+                           type=wait_seconds,
+                           location='args',
+                           default=0,
+                           help="wait must be between 0 and {} seconds.".format(MAX_WAIT))
+
+
+class ChangeList(Resource):
+    """
+    This resource returns the catalog changes after since, oldest first, for incremental sync:
+    a client keeps the 'next' of every response and passes it as since the next time.
+    A new client notes 'last' (the newest change), downloads /items and /stores, then asks for the changes since 'last'.
+    Changes are kept for CHANGES_RETENTION: a client whose since is older gets 410 and downloads the catalog again.
+    With wait (seconds, at most MAX_WAIT) the request waits for a change when there is none yet (long poll),
+    without holding a database connection.
+    """
+    def get(self):
+        args = change_parser.parse_args()
+        since = None if args['since'] is None else decode_cursor(args['since'], [ChangeModel.xid, ChangeModel.seq])
+        if since and ChangeModel.is_pruned(since):
+            return {'message': "The changes since '{}' were pruned, download the catalog again.".format(args['since'])}, 410
+        deadline = time.monotonic() + args['wait']
+        while True:
+            seen = change_feed.seq
+            changes = ChangeModel.since(since, args['limit'])
+            remaining = deadline - time.monotonic()
+            if changes or remaining <= 0:
+                break
+            db.session.rollback() # gives the connection back to the pool, and the next query sees the latest commits
+            change_feed.wait(seen, min(POLL_SECONDS, remaining))
+
+        last = ChangeModel.last_position()
+        return {'changes': [change.json() for change in changes],
+                'next': encode_cursor(changes[-1].position) if changes else args['since'],
+                'last': last and encode_cursor(last)}
@@ -1,6 +1,53 @@
-from flask_restful import Resource, reqparse
-from flask_jwt import jwt_required
-from models.item import ItemModel
+from flask import Response, request, stream_with_context
+from flask_restful import Resource, inputs, reqparse
+from security import jwt_required
+from cache import conditional_response, etag_header, not_modified, response_cache
+from replicas import replica_router
+from models.item import ItemModel, VersionConflict, BULK_CHUNK_SIZE
+from models.change import ChangeModel
+from serializers import serializer
+from resources.pagination import page_parser, paginate, parse_query
+
+EXPORT_BATCH_SIZE = 1000
+SORT_COLUMNS = {'id': None, 'name': ItemModel.name, 'price': ItemModel.price} # None: the id alone is the key
+
+search_parser = page_parser.copy()
+search_parser.add_argument('prefix',
+                           type=str,
+                           location='args',
+                           help="prefix must be the beginning of item names.")
+search_parser.add_argument('min_price',
+                           type=float,
+                           location='args',
+                           help="min_price must be a number.")
+search_parser.add_argument('max_price',
+                           type=float,
+                           location='args',
+                           help="max_price must be a number.")
+search_parser.add_argument('store_id',
+                           type=int,
+                           location='args',
+                           help="store_id must be a store id.")
+search_parser.add_argument('sort',
+                           choices=[order + key for key in SORT_COLUMNS for order in ('', '-')],
+                           location='args',
+                           default='id',
+                           help="sort must be one of id, name or price, optionally prefixed with - for descending order.")
+
+
+def if_match_version(if_match):
+    """
+    The version of the item an If-Match header expects.
+    :param if_match: The parsed header, e.g. request.if_match.
+    :return: A tuple (version, or None without a header or with *, None) or (None, error) if it isn't an item ETag.
+    """
+    if not if_match or if_match.star_tag:
+        return None, None
+    versions = {ItemModel.version_from_etag(etag) for etag in if_match.as_set()}
+    if len(versions) != 1 or None in versions:
+        return None, {'message': "If-Match must be the ETag of the item."}
+    version, = versions
+    return version, None
 
 
 class Item(Resource):
@@ -16,48 +63,144 @@ class Item(Resource):
 
     @jwt_required() # before we get item we need to provide jwt token - that's how works this decorator; if jwt is not there it returns 401 
     def get(self, name):
-        item = ItemModel.find_by_name(name)
-        if item:
-            return item.json()
-        return {'message': 'Item not found'}, 404
+        entry = response_cache.get(ItemModel.cache_key(name))
+        if entry is None:
+            generation = response_cache.generation(ItemModel.cache_key(name))
+            item = ItemModel.find_by_name(name)
+            if not item:
+                return {'message': 'Item not found'}, 404
+            entry = response_cache.set(ItemModel.cache_key(name), item.json(), ItemModel.etag(item.json(), item.version),
+                                       store=not replica_router.lag(), generation=generation)
+        return conditional_response(*entry)
 
     def post(self, name):
-        if ItemModel.find_by_name(name):
-            return {'message': "An item with name '{}' already exists.".format(name)}, 400
-
         data = Item.parser.parse_args()
 
-        item = ItemModel(name, **data)
-
         try:
-            item.save_to_db()
+            created = ItemModel.insert(name, **data) # no lookup first: the insert itself tells us if the name is taken
         except:
             return {"message": "An error occurred inserting the item."}, 500
+        if not created:
+            return {'message': "An item with name '{}' already exists.".format(name)}, 400
 
-        return item.json(), 201
+        payload = {'name': name, 'price': data['price']}
+        return payload, 201, {'ETag': '"{}"'.format(ItemModel.etag(payload, 1))}
 
     def delete(self, name):
-        item = ItemModel.find_by_name(name)
-        if item:
-            item.delete_from_db()
+        ItemModel.delete_by_name(name) # no lookup first, and no version check to lose against a concurrent PUT
 
         return {'message': 'Item deleted'}
 
     def put(self, name):
+        """
+        Creates the item or updates its price in one atomic statement. With If-Match (an ETag from GET)
+        the update only happens if nobody changed the item since, 412 otherwise; If-Match: * only updates existing items.
+        """
         data = Item.parser.parse_args()
+        expected_version, error = if_match_version(request.if_match)
+        if error:
+            return error, 412
 
-        item = ItemModel.find_by_name(name)
+        try:
+            version = ItemModel.upsert(name, data['price'], data['store_id'], expected_version, create=not request.if_match)
+        except VersionConflict:
+            return {'message': "The item '{}' was changed by another request.".format(name)}, 412
+
+        payload = {'name': name, 'price': data['price']}
+        return payload, 200, {'ETag': '"{}"'.format(ItemModel.etag(payload, version))}
+
+
+def clean_bulk_row(row):
+    """
+    Checks one row of a bulk PUT /items the same way Item.parser checks PUT /item/<name>.
+    :return: A tuple (dictionary with name, price and store_id, None) or (None, error message).
+    """
+    if not isinstance(row, dict) or not isinstance(row.get('name'), str) or not row['name']:
+        return None, 'Every item needs a name.'
+    try:
+        price = float(row['price'])
+    except (KeyError, TypeError, ValueError):
+        return None, 'This field cannot be left blank!'
+    try:
+        store_id = int(row['store_id'])
+    except (KeyError, TypeError, ValueError):
+        return None, 'Every item needs a store id.'
+    return {'name': row['name'], 'price': price, 'store_id': store_id}, None
 
-        if item is None:
-            item = ItemModel(name, **data)
-        else:
-            item.price = data['price']
 
-        item.save_to_db()
+class ItemList(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('chunk_size',
+                        type=inputs.positive,
+                        location='args',
+                        default=BULK_CHUNK_SIZE,
+                        help="chunk_size must be a positive number.")
 
-        return item.json()
+    def get(self):
+        """
+        Lists the items, filtered by name prefix, price range and store, in pages of the requested sort order.
+        The ETag is the catalog version: If-None-Match gets a 304 after a single indexed query.
+        """
+        args = parse_query(search_parser, request.args)
+        etag = ChangeModel.catalog_etag()
+        response = not_modified(etag)
+        if response:
+            return response
+        query = ItemModel.records(*ItemModel.search_filters(args['prefix'], args['min_price'], args['max_price'], args['store_id']))
+        descending = args['sort'].startswith('-')
+        sort_column = SORT_COLUMNS[args['sort'].lstrip('-')]
+        if args['all']: # the old unpaginated response, only when explicitly asked for
+            order = [c.desc() if descending else c for c in (sort_column, ItemModel.id) if c is not None]
+            return {'items': [ItemModel.record_json(x) for x in query.order_by(*order)]}, 200, etag_header(etag)
+
+        items, next_cursor = paginate(query, ItemModel.id, args['after'], args['limit'], sort_column, descending)
+        return {'items': [ItemModel.record_json(x) for x in items], 'next': next_cursor}, 200, etag_header(etag)
+
+    def put(self):
+        """
+        Creates or updates many items at once from a JSON array of {name, price, store_id},
+        answering with the outcome of every row in the same order.
+        """
+        rows = request.get_json(silent=True)
+        if not isinstance(rows, list):
+            return {'message': 'Expected a JSON array of items.'}, 400
+        chunk_size = ItemList.parser.parse_args()['chunk_size']
+
+        results = []
+        valid_rows = {} # name -> row, so the same item can't be written twice in one request
+        for row in rows:
+            data, error = clean_bulk_row(row)
+            if data and data['name'] in valid_rows:
+                data, error = None, 'Duplicated item name.'
+            if error:
+                results.append({'name': row.get('name') if isinstance(row, dict) else None, 'status': 'error', 'message': error})
+            else:
+                valid_rows[data['name']] = data
+                results.append({'name': data['name']})
+
+        outcomes = dict(zip(valid_rows, ItemModel.bulk_upsert(list(valid_rows.values()), chunk_size)))
+        for result in results:
+            if 'status' not in result:
+                result['status'] = outcomes[result['name']]
+                if result['status'] == 'error':
+                    result['message'] = 'An error occurred writing the item.'
+        return {'items': results}
+
+
+class ItemExport(Resource):
+    """
+    This resource streams the whole catalog as newline delimited JSON (one item per line),
+    so memory stays flat and the first bytes go out before the last row is read.
+    """
+    def get(self):
+        etag = ChangeModel.catalog_etag()
+        response = not_modified(etag)
+        if response:
+            return response
+        rows = ItemModel.records().order_by(ItemModel.id).execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE) # server-side cursor where the driver supports it
 
+        def generate():
+            for row in rows:
+                yield serializer.dumps(ItemModel.record_json(row)) + b'\n'
 
-class ItemList(Resource):
-    def get(self):
-        return {'items': [x.json() for x in ItemModel.query.all()]}
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers=etag_header(etag))
@@ -0,0 +1,31 @@
+from flask import Response
+from flask_restful import Resource
+from db import db
+from metrics import pool_metrics, request_metrics
+from profiling import profiler
+
+
+class Metrics(Resource):
+    """
+    This resource is scraped by Prometheus: request counts, latency histograms and pool counters.
+    """
+    def get(self):
+        return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+class PoolStats(Resource):
+    """
+    This resource reports the database connection pool: checked out connections, overflow,
+    checkout wait times and connection churn, to size pools against worker counts.
+    """
+    def get(self):
+        return pool_metrics.snapshot(db.engine.pool)
+
+
+class ProfileStats(Resource):
+    """
+    This resource reports, per endpoint, histograms of SQL statement counts, database time,
+    serialization time and total time, plus the slowest statement (needs PROFILE_REQUESTS).
+    """
+    def get(self):
+        return profiler.snapshot()
@@ -0,0 +1,123 @@
+import base64
+import json
+
+from flask_restful import abort, inputs, reqparse
+from sqlalchemy import and_, or_
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+page_parser = reqparse.RequestParser() # shared by every list resource, arguments come from the query string
+page_parser.add_argument('limit',
+                         type=inputs.int_range(1, MAX_LIMIT),
+                         location='args',
+                         default=DEFAULT_LIMIT,
+                         help="limit must be between 1 and {}.".format(MAX_LIMIT))
+page_parser.add_argument('after',
+                         type=str,
+                         location='args',
+                         help="after must be the 'next' cursor of a previous page.")
+page_parser.add_argument('all',
+                         type=inputs.boolean,
+                         location='args',
+                         default=False,
+                         help="all must be true or false.")
+
+
+def parse_query(parser, args):
+    """
+    parser.parse_args() over a plain mapping of query string arguments instead of flask.request,
+    so the ASGI app validates them the same way without Flask's request machinery.
+    Handles what the query string parsers use: type, default, choices and help.
+    :param parser: A RequestParser whose arguments all come from the query string.
+    :param args: A mapping of argument names to strings, e.g. request.args.
+    :return: A dictionary with every argument of the parser; aborts with 400 like reqparse on invalid values.
+    """
+    parsed = {}
+    for argument in parser.args:
+        value = args.get(argument.name)
+        if value is None:
+            parsed[argument.name] = argument.default
+            continue
+        try:
+            value = argument.convert(value, '=')
+            if argument.choices and value not in argument.choices:
+                raise ValueError("{} is not a valid choice".format(value))
+        except Exception as error:
+            abort(400, message={argument.name: argument.help.format(error_msg=error) if argument.help else str(error)})
+        parsed[argument.name] = value
+    return parsed
+
+
+def encode_cursor(values):
+    """
+    Builds the opaque cursor handed to clients as 'next'.
+    :param values: A list with the keyset values of the last row of a page.
+    :return: A url-safe string.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, columns):
+    """
+    Reverse of encode_cursor; aborts the request with 400 if the cursor was tampered with.
+    :param cursor: A string previously returned by encode_cursor.
+    :param columns: The keyset columns, every value must have the type of its column.
+    :return: The list of keyset values.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        values = None
+    if (not isinstance(values, list) or len(values) != len(columns)
+            or not all(is_key_value(value, column) for value, column in zip(values, columns))):
+        abort(400, message="Invalid cursor '{}'.".format(cursor))
+    return values
+
+
+def is_key_value(value, column):
+    """
+    Whether a cursor value can be compared with the column, so a tampered cursor never reaches the database.
+    """
+    python_type = column.type.python_type
+    if isinstance(value, bool): # a bool is an int to isinstance, never a key
+        return False
+    if python_type is float:
+        return isinstance(value, (int, float))
+    return isinstance(value, python_type)
+
+
+def paginate(query, column, after=None, limit=DEFAULT_LIMIT, sort_column=None, descending=False):
+    """
+    Keyset pagination: instead of OFFSET we continue right after the last seen key,
+    so every page costs O(limit) with an index on the key, no matter how deep we are.
+    :param query: A SQLAlchemy query over the rows to paginate.
+    :param column: A unique, ordered column such as Model.id.
+    :param after: The cursor returned with the previous page, None for the first page.
+    :param limit: Maximum number of rows in the page.
+    :param sort_column: Sort by this (not necessarily unique) column first, ties are broken by column.
+    :param descending: Sort from the highest key down.
+    :return: A tuple (rows, next cursor or None when this is the last page).
+    """
+    columns = [sort_column, column] if sort_column is not None else [column]
+    if after is not None:
+        last_key = decode_cursor(after, columns)
+        query = query.filter(after_key(columns, last_key, descending))
+    order = [c.desc() if descending else c.asc() for c in columns]
+    rows = query.order_by(*order).limit(limit + 1).all() # one extra row tells us if there is a next page
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor([getattr(rows[-1], c.key) for c in columns])
+    return rows, None
+
+
+def after_key(columns, values, descending=False):
+    """
+    The condition for rows coming after values in the (columns) order, written out as
+    (a > x) OR (a = x AND b > y) so every database can use the index on the columns.
+    """
+    column, value = columns[0], values[0]
+    beyond = column < value if descending else column > value
+    if len(columns) == 1:
+        return beyond
+    return or_(beyond, and_(column == value, after_key(columns[1:], values[1:], descending)))
@@ -1,13 +1,58 @@
 from flask_restful import Resource
+from sqlalchemy.exc import IntegrityError
+from cache import conditional_response, etag_header, not_modified, response_cache
+from replicas import replica_router
+from models.change import ChangeModel
+from models.item import ItemModel
 from models.store import StoreModel
+from resources.pagination import page_parser, paginate
+
+store_parser = page_parser.copy()
+store_parser.add_argument('items',
+                          choices=('all', 'none', 'count', 'page'),
+                          location='args',
+                          default='all',
+                          help="items must be all, none, count or page.")
+
+
+def items_page(store, args):
+    """
+    One keyset page of the items of a store, sliced by the database.
+    :return: A tuple (list of item dictionaries, next cursor or None).
+    """
+    items, next_cursor = paginate(store.item_records(), ItemModel.id, args['after'], args['limit'])
+    return [ItemModel.record_json(item) for item in items], next_cursor
 
 
 class Store(Resource):
     def get(self, name):
-        store = StoreModel.find_by_name(name)
-        if store:
-            return store.json()
-        return {'message': 'Store not found'}, 404
+        """
+        The store with all its items (items=all, the default), none of them, their count,
+        or their first page (items=page, with limit and after like /store/<name>/items).
+        """
+        args = store_parser.parse_args()
+        if args['items'] == 'page': # pages aren't cached, there are too many of them to invalidate
+            store = StoreModel.find_by_name(name)
+            if not store:
+                return {'message': 'Store not found'}, 404
+            items, next_cursor = items_page(store, args)
+            return {'name': store.name, 'items': items, 'next': next_cursor}
+
+        key = StoreModel.cache_key(name, args['items'])
+        entry = response_cache.get(key)
+        if entry is None:
+            generation = response_cache.generation(key)
+            store = StoreModel.find_by_name(name)
+            if not store:
+                return {'message': 'Store not found'}, 404
+            if args['items'] == 'none':
+                payload = {'name': store.name}
+            elif args['items'] == 'count':
+                payload = {'name': store.name, 'item_count': store.items.count()}
+            else:
+                payload = store.json()
+            entry = response_cache.set(key, payload, store=not replica_router.lag(), generation=generation)
+        return conditional_response(*entry)
 
     def post(self, name):
         if StoreModel.find_by_name(name):
@@ -16,6 +61,8 @@ class Store(Resource):
         store = StoreModel(name)
         try:
             store.save_to_db()
+        except IntegrityError: # another request created the same name between our check and the insert
+            return {'message': "A store with name '{}' already exists.".format(name)}, 400
         except:
             return {"message": "An error occurred creating the store."}, 500
 
@@ -29,6 +76,59 @@ class Store(Resource):
         return {'message': 'Store deleted'}
 
 
+class StoreItems(Resource):
+    """
+    This resource pages through the items of one store, so big stores never go out in one response.
+    """
+    def get(self, name):
+        args = page_parser.parse_args()
+        store = StoreModel.find_by_name(name)
+        if not store:
+            return {'message': 'Store not found'}, 404
+        if args['all']:
+            return {'items': [ItemModel.record_json(item) for item in store.item_records().order_by(ItemModel.id)]}
+
+        items, next_cursor = items_page(store, args)
+        return {'items': items, 'next': next_cursor}
+
+
 class StoreList(Resource):
     def get(self):
-        return {'stores': [store.json() for store in StoreModel.query.all()]}
+        """
+        Lists the stores with their items; like /items, the ETag is the catalog version.
+        """
+        args = page_parser.parse_args()
+        etag = ChangeModel.catalog_etag()
+        response = not_modified(etag)
+        if response:
+            return response
+        if args['all']: # the old unpaginated response, only when explicitly asked for
+            return {'stores': StoreModel.json_many(StoreModel.records().order_by(StoreModel.id).all())}, 200, etag_header(etag) # 2 queries no matter how many stores there are
+
+        stores, next_cursor = paginate(StoreModel.records(), StoreModel.id, args['after'], args['limit'])
+        return {'stores': StoreModel.json_many(stores), 'next': next_cursor}, 200, etag_header(etag)
+
+
+class StoreSummary(Resource):
+    """
+    This resource returns the item count and price statistics of a store without loading its items.
+    """
+    def get(self, name):
+        entry = response_cache.get(StoreModel.summary_cache_key(name))
+        if entry is None:
+            generation = response_cache.generation(StoreModel.summary_cache_key(name))
+            summaries = StoreModel.summaries(name)
+            if not summaries:
+                return {'message': 'Store not found'}, 404
+            entry = response_cache.set(StoreModel.summary_cache_key(name), summaries[0], store=not replica_router.lag(), generation=generation)
+        return conditional_response(*entry)
+
+
+class StoreSummaryList(Resource):
+    def get(self):
+        entry = response_cache.get(StoreModel.summary_cache_key())
+        if entry is None:
+            generation = response_cache.generation(StoreModel.summary_cache_key())
+            entry = response_cache.set(StoreModel.summary_cache_key(), {'stores': StoreModel.summaries()}, store=not replica_router.lag(),
+                                       generation=generation)
+        return conditional_response(*entry)
@@ -1,5 +1,9 @@
+from flask_jwt import current_identity
 from flask_restful import Resource, reqparse
+from sqlalchemy.exc import IntegrityError
 from models.user import UserModel
+from passwords import hash_password
+from security import jwt_required, revoke_tokens
 
 
 class UserRegister(Resource):
@@ -23,7 +27,20 @@ class UserRegister(Resource):
         if UserModel.find_by_username(data['username']):
             return {'message': 'A user with that username already exist'}, 400
 
-        user = UserModel(**data)
-        user.save_to_db()
+        user = UserModel(data['username'], hash_password(data['password']))
+        try:
+            user.save_to_db()
+        except IntegrityError: # another request registered the same username between our check and the insert
+            return {'message': 'A user with that username already exist'}, 400
+
+        return {'message': 'User created successfully.'}, 201
 
-        return {'message': 'User created successfully.'}, 201
\ No newline at end of file
+class UserLogout(Resource):
+    """
+    This resource revokes every token of the caller, so they can't be used until they expire
+    """
+    @jwt_required()
+    def post(self):
+        if not revoke_tokens(current_identity.id):
+            return {'message': 'Too many recent logouts, please retry later.'}, 503
+        return {'message': 'Logged out successfully.'}
@@ -1,17 +1,52 @@
-import hmac
-from models.user import UserModel
+import logging
+import os
+import time
+from functools import wraps
+
+import jwt
+from flask import _request_ctx_stack, current_app
+from flask_jwt import JWTError, _default_jwt_payload_handler, _jwt
+from werkzeug.local import LocalProxy
+
+from cache import RedisCache, TTLCache
+from models.user import UserModel, identity_cache
+from passwords import hash_password, needs_rehash, verify_password
+
+logger = logging.getLogger(__name__)
+
+# user id -> time of the revocation; tokens issued until then are refused.
+# Entries only need to outlive the tokens (see init_revocations), and are never evicted before:
+# with REVOKED_TOKENS_SIZE users revoked, further revocations are refused.
+# In process by default, so a logout only reaches the other workers with REVOKED_TOKENS_REDIS_URL.
+revoked_tokens = TTLCache(maxsize=int(os.environ.get('REVOKED_TOKENS_SIZE', 10000)))
+
+
+def init_revocations(app):
+    """
+    Keeps revocations as long as Flask-JWT accepts the tokens: JWT_EXPIRATION_DELTA plus JWT_LEEWAY.
+    With the REVOKED_TOKENS_REDIS_URL setting they are kept in Redis, shared by the workers.
+    """
+    global revoked_tokens
+    if app.config.get('REVOKED_TOKENS_REDIS_URL'):
+        import redis
+        revoked_tokens = RedisCache(redis.Redis.from_url(app.config['REVOKED_TOKENS_REDIS_URL']), prefix='stores-rest-api-revoked:')
+    revoked_tokens.ttl = (app.config['JWT_EXPIRATION_DELTA'] + app.config['JWT_LEEWAY']).total_seconds()
 
 
 def authenticate(username, password):
     """
     Function that gets called when a user calls the /auth endpoint
     with their username and password.
+    Passwords stored in plaintext or with outdated hash settings are rehashed on a successful login.
     :param username: User's name in string format.
     :param password: User's un-encrypted password in string format.
     :return: A UserModel object if authentication was successful, None otherwise.
     """
     user = UserModel.find_by_username(username)
-    if user and hmac.compare_digest(user.password, password):
+    if user and verify_password(password, user.password):
+        if needs_rehash(user.password):
+            user.password = hash_password(password)
+            user.save_to_db()
         return user
 
 
@@ -19,8 +54,98 @@ def identity(payload):
     """
     Function that gets called when user has already authenticated, and Flask_JWT
     verified their authorization header is correct.
+    Users are cached for a short time, so authenticated requests don't reload them every time.
     :param payload: A dictionary with 'identity' key, which is the user id.
     :return: A UserModel object.
     """
     user_id = payload['identity']
-    return UserModel.find_by_id(user_id)
\ No newline at end of file
+    user = identity_cache.get(user_id)
+    if user is None:
+        user = UserModel.find_by_id(user_id)
+        if user:
+            identity_cache.set(user_id, user.detached_copy())
+    return user
+
+
+def jwt_payload(identity):
+    """
+    Flask-JWT's token payload with the exact issue time: iat only has whole seconds,
+    so a token issued right after a logout would look revoked.
+    """
+    payload = _default_jwt_payload_handler(identity)
+    payload['issued_at'] = time.time()
+    return payload
+
+
+def revoke_tokens(user_id):
+    """
+    Refuses every token issued to the user so far, e.g. on logout.
+    :param user_id: The id of the user.
+    :return: False if the revocation list is full, the tokens are still valid then.
+    """
+    if revoked_tokens.add(user_id, time.time()):
+        return True
+    logger.warning("The token revocation list is full (REVOKED_TOKENS_SIZE), user %s stays logged in", user_id)
+    return False
+
+
+def is_revoked(payload):
+    """
+    :param payload: A decoded token.
+    :return: True if the token was issued before its user's tokens were revoked.
+    """
+    revoked_at = revoked_tokens.get(payload['identity'])
+    if revoked_at is None:
+        return False
+    if 'issued_at' not in payload: # issued before jwt_payload, whole seconds: give the benefit of the doubt to the same second
+        return payload['iat'] < int(revoked_at)
+    return payload['issued_at'] <= revoked_at
+
+
+def lazy_identity(payload):
+    """
+    A stand-in for identity(payload) which only loads the user when it is first used.
+    """
+    loaded = []
+
+    def load():
+        if not loaded:
+            user = _jwt.identity_callback(payload)
+            if user is None:
+                raise JWTError('Invalid JWT', 'User does not exist')
+            loaded.append(user)
+        return loaded[0]
+    return LocalProxy(load)
+
+
+def jwt_required(realm=None):
+    """
+    flask_jwt's jwt_required, also refusing revoked tokens. With the JWT_LAZY_IDENTITY setting only the signature
+    and the claims (expiry...) are verified up front; current_identity loads the user when the view uses it,
+    so views which only need an authenticated caller don't query the database.
+    :param realm: The realm of the WWW-Authenticate header when the token is missing.
+    """
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            token = _jwt.request_callback()
+            if token is None:
+                raise JWTError('Authorization Required', 'Request does not contain an access token',
+                               headers={'WWW-Authenticate': 'JWT realm="%s"' % (realm or current_app.config['JWT_DEFAULT_REALM'])})
+            try:
+                payload = _jwt.jwt_decode_callback(token)
+            except jwt.InvalidTokenError as e:
+                raise JWTError('Invalid token', str(e))
+            if is_revoked(payload):
+                raise JWTError('Invalid token', 'Token has been revoked')
+
+            if current_app.config.get('JWT_LAZY_IDENTITY'):
+                identity = lazy_identity(payload)
+            else:
+                identity = _jwt.identity_callback(payload)
+                if identity is None:
+                    raise JWTError('Invalid JWT', 'User does not exist')
+            _request_ctx_stack.top.current_identity = identity # where flask_jwt.current_identity looks
+            return fn(*args, **kwargs)
+        return decorator
+    return wrapper
@@ -0,0 +1,55 @@
+"""
+Measures /auth requests per second for every password hash setting,
+with the verification cache disabled (every login runs the KDF) and enabled.
+Run it from the repository root:
+
+    python -m tests.benchmark.bench_auth --requests 100 --concurrency 4
+
+Prints one JSON document per setting, with the throughput and latency percentiles of both runs.
+"""
+import argparse
+import json
+
+from tests.benchmark.common import Client, create_app, run
+
+SETTINGS = [('pbkdf2_sha256', 100000), ('pbkdf2_sha256', 300000), ('pbkdf2_sha256', 600000),
+            ('scrypt', 12), ('scrypt', 14), ('scrypt', 15)]
+
+
+def login(number):
+    return 'POST', '/auth', {'username': 'bench', 'password': '1234'}, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    app = create_app()
+    import passwords
+    from models.user import UserModel
+
+    with app.app_context():
+        UserModel('bench', '1234').save_to_db()
+    client = Client(app)
+
+    for algorithm, cost in SETTINGS:
+        passwords.ALGORITHM, passwords.COST = algorithm, cost # so logins don't rehash
+        with app.app_context():
+            user = UserModel.find_by_username('bench')
+            user.password = passwords.hash_password('1234')
+            user.save_to_db()
+
+        result = {'algorithm': algorithm, 'cost': cost, 'requests': args.requests, 'concurrency': args.concurrency}
+        passwords._verified.clear()
+        passwords._verified.maxsize = 0 # nothing is kept, every login runs the KDF
+        result['uncached'] = run(client, 'POST /auth', login, args.requests, args.concurrency)
+        passwords._verified.maxsize = 1024
+        run(client, 'POST /auth', login, 1, 1) # warm the cache up
+        result['cached'] = run(client, 'POST /auth', login, args.requests, args.concurrency)
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
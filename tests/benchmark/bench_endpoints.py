@@ -0,0 +1,87 @@
+"""
+Load test of every endpoint against a seeded catalog. Run it from the repository root:
+
+    python -m tests.benchmark.bench_endpoints --stores 100 --items-per-store 50 --users 10 \
+        --requests 500 --concurrency 8 --output bench.json
+
+By default the app runs in-process on a new SQLite file; with --url the requests go to a running server
+instead (seed its database with the same volumes first, e.g. with --seed-only and DATABASE_URL).
+The report is one JSON document per scenario, compare two of them with tests.benchmark.compare.
+"""
+import argparse
+import json
+import os
+
+from tests.benchmark.common import Client, create_app, run, seed
+
+
+def scenarios(args, tokens):
+    """
+    :param tokens: Authorization header values, one per seeded user.
+    :return: A list of (name, function of the request number returning (method, path, payload, headers)).
+    """
+    def store_name(number):
+        return 'store-{}'.format(number % args.stores)
+
+    def item_name(number):
+        return 'item-{}-{}'.format(number % args.stores, number % args.items_per_store)
+
+    return [
+        ('GET /stores', lambda n: ('GET', '/stores', None, None)),
+        ('GET /stores?all=true', lambda n: ('GET', '/stores?all=true', None, None)),
+        ('GET /store/<name>', lambda n: ('GET', '/store/' + store_name(n), None, None)),
+        ('GET /items', lambda n: ('GET', '/items', None, None)),
+        ('GET /items?all=true', lambda n: ('GET', '/items?all=true', None, None)),
+        ('GET /store/<name>?items=page', lambda n: ('GET', '/store/store-{}?items=page'.format(n % args.stores), None, None)),
+        ('GET /store/<name>/items', lambda n: ('GET', '/store/store-{}/items'.format(n % args.stores), None, None)),
+        ('GET /items?prefix=', lambda n: ('GET', '/items?prefix=item-{}-1'.format(n % args.stores), None, None)),
+        ('GET /items?min_price=&sort=-price', lambda n: ('GET', '/items?store_id={}&min_price=10&sort=-price'.format(n % args.stores + 1), None, None)),
+        ('GET /items/export', lambda n: ('GET', '/items/export', None, None)),
+        ('GET /item/<name>', lambda n: ('GET', '/item/' + item_name(n), None, {'Authorization': tokens[n % len(tokens)]})),
+        ('PUT /item/<name>', lambda n: ('PUT', '/item/' + item_name(n), {'price': n % 100 + 0.5, 'store_id': n % args.stores + 1}, None)),
+        ('POST /auth', lambda n: ('POST', '/auth', {'username': 'user-{}'.format(n % args.users), 'password': '1234'}, None)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stores', type=int, default=100)
+    parser.add_argument('--items-per-store', type=int, default=50)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=500, help="requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--scenario', action='append', help="only run these scenarios (repeatable)")
+    parser.add_argument('--url', help="base url of a running server, instead of the in-process app")
+    parser.add_argument('--seed-only', action='store_true', help="seed the DATABASE_URL database and exit")
+    parser.add_argument('--output', help="also write the report to this file")
+    args = parser.parse_args()
+
+    app = create_app(os.environ.get('DATABASE_URL') if args.seed_only else None)
+    if args.url is None or args.seed_only:
+        seed(app, args.stores, args.items_per_store, args.users)
+    if args.seed_only:
+        return
+
+    client = Client(app, args.url)
+    tokens = []
+    for user in range(args.users):
+        status, _, body = client.request('POST', '/auth', {'username': 'user-{}'.format(user), 'password': '1234'})
+        assert status == 200, body
+        tokens.append('JWT ' + json.loads(body)['access_token'])
+
+    report = []
+    for name, make_request in scenarios(args, tokens):
+        if args.scenario and name not in args.scenario:
+            continue
+        result = run(client, name, make_request, args.requests, args.concurrency)
+        result['data'] = {'stores': args.stores, 'items_per_store': args.items_per_store, 'users': args.users}
+        print(json.dumps(result))
+        report.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
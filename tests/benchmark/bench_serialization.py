@@ -0,0 +1,69 @@
+"""
+Compares rendering the item list the way the resources used to (ORM instances, json() dicts, stdlib json)
+with the way they do now (ItemModel.records() rows through record_json, orjson when installed), for every available backend.
+Run it from the repository root:
+
+    python -m tests.benchmark.bench_serialization --items 100000 --repeat 5
+
+Prints one JSON document per variant with the median time to query and encode the whole catalog
+and the peak memory allocated by Python while doing it.
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from tests.benchmark.common import create_app, percentile, seed
+
+
+def orm_payload():
+    from models.item import ItemModel
+    return {'items': [item.json() for item in ItemModel.query.all()]}
+
+
+def records_payload():
+    from models.item import ItemModel
+    return {'items': [ItemModel.record_json(row) for row in ItemModel.records()]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    seed(app, 1, args.items, 0)
+    from db import db
+    from serializers import BACKENDS, get_backend
+
+    backends = []
+    for name in BACKENDS:
+        try:
+            backends.append(get_backend(name))
+        except ValueError: # not installed
+            pass
+
+    for rows, make_payload in (('orm', orm_payload), ('records', records_payload)):
+        for backend in backends:
+            timings = []
+            size = 0
+            with app.app_context():
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    size = len(backend.dumps(make_payload()))
+                    timings.append(time.perf_counter() - start)
+                    db.session.remove() # every run starts with an empty identity map, like a request
+                tracemalloc.start() # not during the timed runs, tracing slows allocations down
+                backend.dumps(make_payload())
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                db.session.remove()
+            median = percentile(timings, 50)
+            print(json.dumps({'variant': '{}+{}'.format(rows, backend.name), 'items': args.items, 'bytes': size,
+                              'median_ms': round(median * 1000, 2), 'items_per_second': round(args.items / median),
+                              'peak_memory_kb': peak // 1024}))
+
+
+if __name__ == '__main__':
+    main()
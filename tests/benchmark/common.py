@@ -0,0 +1,130 @@
+"""
+Helpers shared by the benchmarks: an app on a throwaway SQLite file, seeding,
+and a load driver reporting throughput, latency percentiles and queries per request.
+"""
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def create_app(database_uri=None):
+    """
+    Imports the app on its own database; must run before anything else imports app.
+    :param database_uri: Where to store the data, a new SQLite file by default.
+    :return: The Flask app, with the tables created.
+    """
+    os.environ['DATABASE_URL'] = database_uri or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    from app import app
+    from db import db
+
+    app.config['DEBUG'] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def seed(app, stores, items_per_store, users, password='1234'):
+    """
+    Fills the database with stores named store-<n>, items named item-<store>-<n> and users named user-<n>,
+    using bulk inserts so big volumes are quick to set up.
+    """
+    from db import db
+    from models.item import ItemModel
+    from models.store import StoreModel
+    from models.user import UserModel
+    from passwords import hash_password
+
+    with app.app_context():
+        db.session.bulk_insert_mappings(StoreModel, [{'id': n + 1, 'name': 'store-{}'.format(n)} for n in range(stores)])
+        for store in range(stores): # one batch per store keeps memory low for big catalogs
+            db.session.bulk_insert_mappings(ItemModel, [{'name': 'item-{}-{}'.format(store, n), 'price': n + 0.99, 'store_id': store + 1}
+                                                        for n in range(items_per_store)])
+        hashed = hash_password(password) # the same hash for everybody, hashing is not what we measure here
+        db.session.bulk_insert_mappings(UserModel, [{'username': 'user-{}'.format(n), 'password': hashed} for n in range(users)])
+        db.session.commit()
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of a list of numbers.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+class Client:
+    """
+    Sends requests to the app in-process (Flask test client), or over HTTP when a base url is given.
+    """
+    def __init__(self, app=None, url=None):
+        self.app = app
+        self.url = url.rstrip('/') if url else None
+
+    def request(self, method, path, payload=None, headers=None):
+        """
+        :return: A tuple (status code, headers, body bytes).
+        """
+        headers = dict(headers or {})
+        if self.url is None:
+            with self.app.test_client() as client:
+                resp = client.open(path, method=method, json=payload, headers=headers)
+                return resp.status_code, resp.headers, resp.data
+        data = None
+        if payload is not None:
+            data = json.dumps(payload).encode()
+            headers['Content-Type'] = 'application/json'
+        http_request = urllib.request.Request(self.url + path, data=data, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(http_request) as resp:
+                return resp.status, resp.headers, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+
+def run(client, name, make_request, requests, concurrency):
+    """
+    Sends requests from concurrency threads and measures every one of them.
+    :param client: A Client.
+    :param name: The name of the scenario in the report.
+    :param make_request: A function of the request number returning (method, path, payload, headers).
+    :return: A dictionary with throughput, latency percentiles (ms), queries per request and status counts.
+    """
+    latencies = []
+    queries = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def send(number):
+        method, path, payload, headers = make_request(number)
+        start = time.perf_counter()
+        status, response_headers, _ = client.request(method, path, payload, headers)
+        latency = time.perf_counter() - start
+        with lock:
+            latencies.append(latency)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if response_headers.get('X-Query-Count') is not None:
+                queries.append(int(response_headers['X-Query-Count']))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    return {'scenario': name,
+            'requests': requests,
+            'concurrency': concurrency,
+            'throughput_rps': round(requests / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+            'statuses': statuses}
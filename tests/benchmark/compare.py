@@ -0,0 +1,65 @@
+"""
+Compares two reports of tests.benchmark.bench_endpoints, e.g. from the base branch and from a change:
+
+    python -m tests.benchmark.compare base.json change.json --tolerance 10
+
+Prints the change of every metric per scenario and exits with 1 if a scenario got slower
+(throughput down, p95 up) by more than the tolerance in percent, or runs more queries per request.
+"""
+import argparse
+import json
+import sys
+
+
+def compare(base, change, tolerance):
+    """
+    :param base: A list of scenario results.
+    :param change: A list of scenario results.
+    :param tolerance: Allowed slowdown in percent.
+    :return: A tuple (list of per scenario comparisons, list of regression messages).
+    """
+    base_by_name = {result['scenario']: result for result in base}
+    comparisons = []
+    regressions = []
+    for result in change:
+        before = base_by_name.get(result['scenario'])
+        if before is None:
+            continue
+        comparison = {'scenario': result['scenario']}
+        for metric in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request'):
+            if before.get(metric) and result.get(metric) is not None:
+                comparison[metric] = {'base': before[metric], 'change': result[metric],
+                                      'percent': round((result[metric] - before[metric]) / before[metric] * 100, 1)}
+        comparisons.append(comparison)
+
+        if 'throughput_rps' in comparison and comparison['throughput_rps']['percent'] < -tolerance:
+            regressions.append("{}: throughput {}%".format(result['scenario'], comparison['throughput_rps']['percent']))
+        if 'p95_ms' in comparison and comparison['p95_ms']['percent'] > tolerance:
+            regressions.append("{}: p95 +{}%".format(result['scenario'], comparison['p95_ms']['percent']))
+        if (result.get('queries_per_request') or 0) > (before.get('queries_per_request') or 0):
+            regressions.append("{}: {} queries per request instead of {}".format(
+                result['scenario'], result['queries_per_request'], before.get('queries_per_request')))
+    return comparisons, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('change')
+    parser.add_argument('--tolerance', type=float, default=10.0, help="allowed slowdown in percent")
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.change) as f:
+        change = json.load(f)
+    comparisons, regressions = compare(base, change, args.tolerance)
+    for comparison in comparisons:
+        print(json.dumps(comparison))
+    for regression in regressions:
+        print("REGRESSION " + regression, file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
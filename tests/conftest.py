@@ -1,10 +1,18 @@
 from app import app
 from db import db
 import pytest
-from models.user import UserModel
+from models.user import UserModel, identity_cache
+from cache import response_cache
+from security import revoked_tokens
 import json
 
 
+def clear_caches(): # the database is dropped after each test, so everything cached from it must go too
+    response_cache.clear()
+    identity_cache.clear()
+    revoked_tokens.clear()
+
+
 @pytest.fixture(scope="module")
 def setup_app():
     global app
@@ -25,6 +33,7 @@ def setup_tests(request):
     with app.app_context():
         db.session.remove()
         db.drop_all()
+    clear_caches()
 
 @pytest.fixture(scope="function")    
 def setup_tests_system_item(request):
@@ -45,5 +54,4 @@ def setup_tests_system_item(request):
     with app.app_context():
         db.session.remove()
         db.drop_all()
-
-    
\ No newline at end of file
+    clear_caches()
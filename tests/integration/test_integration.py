@@ -1,7 +1,15 @@
+import time
+
 import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
+from db import db
 from models.store import StoreModel
-from models.item import ItemModel
+from models.item import ItemModel, VersionConflict
 from models.user import UserModel
+from models.change import ChangeModel
+from metrics import InstrumentedQueuePool, pool_metrics
+from committer import committer
 
 @pytest.mark.integration
 @pytest.mark.usefixtures("setup_app", "setup_tests")
@@ -21,6 +29,109 @@ class ItemTests:
 
             assert not ItemModel.find_by_name('test'), f"Found an item with name {item.name}, but expected not to."
         
+    def test_unique_name(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            ItemModel('test', 19.99, 1).save_to_db()
+
+            with pytest.raises(IntegrityError):
+                ItemModel('test', 5, 1).save_to_db()
+
+            assert ItemModel.find_by_name('test').price == 19.99, "The session is not usable after the failed insert."
+
+    def test_bulk_upsert(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            ItemModel('test', 19.99, 1).save_to_db()
+            expected_outcomes = ['updated', 'created', 'created']
+
+            actual_outcomes = ItemModel.bulk_upsert([{'name': 'test', 'price': 5, 'store_id': 1},
+                                                     {'name': 'test2', 'price': 6, 'store_id': 1},
+                                                     {'name': 'test3', 'price': 7, 'store_id': 1}], chunk_size=2)
+
+            assert actual_outcomes == expected_outcomes
+            assert [item.json() for item in StoreModel.find_by_name('test').items] == [{'name': 'test', 'price': 5},
+                                                                                   {'name': 'test2', 'price': 6},
+                                                                                   {'name': 'test3', 'price': 7}]
+
+    def test_search(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            for name, price in (('test', 19.99), ('test2', 5), ('other', 5)):
+                ItemModel(name, price, 1).save_to_db()
+            expected_names = ['test2']
+
+            actual_names = [item.name for item in ItemModel.search(prefix='test', max_price=10, store_id=1)]
+
+            assert actual_names == expected_names
+            assert [item.name for item in ItemModel.search(prefix='test\U0010ffff')] == [], "The highest code point has no successor."
+
+    def test_insert(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+
+            assert ItemModel.insert('test', 19.99, 1), "The item should have been created."
+            assert not ItemModel.insert('test', 5, 1), "The item already exists."
+            assert ItemModel.find_by_name('test').price == 19.99
+
+    def test_upsert(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+
+            assert ItemModel.upsert('test', 19.99, 1) == 1
+            assert ItemModel.upsert('test', 5, 1) == 2
+            assert ItemModel.upsert('test', 6, 1, expected_version=2) == 3
+            with pytest.raises(VersionConflict):
+                ItemModel.upsert('test', 7, 1, expected_version=2)
+            with pytest.raises(VersionConflict):
+                ItemModel.upsert('missing', 7, 1, create=False)
+            assert ItemModel.find_by_name('test').price == 6
+
+    def test_delete_by_name(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            ItemModel('test', 19.99, 1).save_to_db()
+            ItemModel.find_by_name('test') # loaded at version 1 ...
+            with db.engine.begin() as connection: # ... and updated by another request
+                connection.execute(ItemModel.__table__.update().values(price=5, version=2))
+
+            assert ItemModel.delete_by_name('test')
+            assert not ItemModel.delete_by_name('test')
+            assert ItemModel.query.count() == 0
+
+    def test_upsert_without_on_conflict(self, monkeypatch):
+        monkeypatch.setattr('models.item.on_conflict_insert', lambda session, table: None) # like a database without ON CONFLICT
+        with self.app_context():
+            StoreModel('test').save_to_db()
+
+            assert ItemModel.insert('test', 19.99, 1)
+            assert not ItemModel.insert('test', 5, 1)
+            assert ItemModel.upsert('test', 5, 1) == 2
+            assert ItemModel.upsert('test2', 6, 1) == 1
+            assert [item.json() for item in ItemModel.query.order_by(ItemModel.id)] == [{'name': 'test', 'price': 5}, {'name': 'test2', 'price': 6}]
+
+    def test_orm_update_bumps_version(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            item = ItemModel('test', 19.99, 1)
+            item.save_to_db()
+            item.price = 5
+            item.save_to_db()
+
+            assert item.version == 2
+
+    def test_records(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            ItemModel('test', 19.99, 1).save_to_db()
+            db.session.expunge_all()
+            expected_json = [{'name': 'test', 'price': 19.99}]
+
+            actual_json = [ItemModel.record_json(row) for row in ItemModel.records(ItemModel.store_id == 1)]
+
+            assert actual_json == expected_json
+            assert len(db.session.identity_map) == 0, "Records must not load ItemModel instances."
+
     def test_store_relationship(self):
         with self.app_context():
             store = StoreModel('test_store')
@@ -108,6 +219,33 @@ class StoreTests:
             assert actual_json == expected_json
 
 
+    def test_store_summaries(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            StoreModel('empty').save_to_db()
+            ItemModel('test item', 100, 1).save_to_db()
+            ItemModel('test item2', 50, 1).save_to_db()
+            expected_summaries = [{'name': 'test', 'item_count': 2, 'min_price': 50, 'max_price': 100, 'avg_price': 75},
+                                  {'name': 'empty', 'item_count': 0, 'min_price': None, 'max_price': None, 'avg_price': None}]
+
+            actual_summaries = StoreModel.summaries()
+
+            assert actual_summaries == expected_summaries
+            assert StoreModel.summaries('empty') == expected_summaries[1:]
+
+    def test_store_json_many(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            StoreModel('test2').save_to_db()
+            ItemModel('test item', 100, 1).save_to_db()
+            stores = StoreModel.query.all()
+            expected_json = [store.json() for store in stores]
+
+            actual_json = StoreModel.json_many(stores)
+
+            assert actual_json == expected_json
+
+
 @pytest.mark.integration
 @pytest.mark.usefixtures("setup_app", "setup_tests")
 class UserTests:
@@ -125,4 +263,144 @@ class UserTests:
             actual_id = UserModel.find_by_id(1).id
 
             assert actual_username == expected_username
-            assert actual_id == expected_id
\ No newline at end of file
+            assert actual_id == expected_id
+
+
+@pytest.mark.integration
+class PoolMetricsTests:
+    def test_checkout_timeout(self, tmp_path):
+        engine = create_engine('sqlite:///{}'.format(tmp_path / 'pool.db'), poolclass=InstrumentedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.01)
+        timeouts_before = pool_metrics.counters['checkout_timeouts']
+        waits_before = pool_metrics.checkout_wait.count
+
+        with engine.connect():
+            with pytest.raises(PoolTimeoutError):
+                engine.connect()
+            snapshot = pool_metrics.snapshot(engine.pool)
+
+        assert snapshot['pool']['checked_out'] == 1
+        assert snapshot['checkout_timeouts'] == timeouts_before + 1
+        assert snapshot['checkout_wait_seconds']['count'] == waits_before + 2
+        engine.dispose()
+
+
+@pytest.mark.integration
+@pytest.mark.usefixtures("setup_app", "setup_tests")
+class GroupCommitTests:
+    @pytest.fixture(autouse=True)
+    def group_commit(self, monkeypatch):
+        monkeypatch.setattr(committer, 'window', 0.05)
+
+    def test_save_and_delete(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            item = ItemModel('test', 19.99, 1)
+            item.save_to_db()
+            item.price = 5
+            item.save_to_db()
+
+            assert item.id is not None
+            assert item.version == 2
+            assert item.store.name == 'test'
+            assert ItemModel.find_by_name('test').price == 5
+
+            item.delete_from_db()
+
+            assert ItemModel.find_by_name('test') is None
+
+    def test_batch_isolates_errors(self):
+        def fail(session):
+            raise ValueError("This write fails.")
+
+        with self.app_context():
+            batches_before = committer.batches
+            futures = [committer.enqueue(lambda session: session.add(StoreModel('a'))),
+                       committer.enqueue(fail),
+                       committer.enqueue(lambda session: session.add(StoreModel('b')))]
+
+            assert futures[0].result() is None
+            with pytest.raises(ValueError):
+                futures[1].result()
+            assert futures[2].result() is None
+            assert committer.batches == batches_before + 1, "The writes should have been committed together."
+            assert [store.name for store in StoreModel.query.order_by(StoreModel.id)] == ['a', 'b']
+
+    def test_thread_survives_errors(self, monkeypatch):
+        commit_batch = committer.commit_batch
+
+        def broken_commit_batch(batch):
+            monkeypatch.setattr(committer, 'commit_batch', commit_batch) # only the first batch fails
+            raise OSError("The connection was lost.")
+
+        with self.app_context():
+            monkeypatch.setattr(committer, 'commit_batch', broken_commit_batch)
+            with pytest.raises(OSError):
+                committer.enqueue(lambda session: session.add(StoreModel('a'))).result(timeout=5)
+
+            assert committer.enqueue(lambda session: session.add(StoreModel('b'))).result(timeout=5) is None
+            assert [store.name for store in StoreModel.query] == ['b']
+
+    def test_changes_logged_once(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            ItemModel('test', 19.99, 1).save_to_db()
+
+            assert [(change.type, change.name) for change in ChangeModel.since(None, 10)] == [('store', 'test'), ('item', 'test')]
+
+
+@pytest.mark.integration
+@pytest.mark.usefixtures("setup_app", "setup_tests")
+class ChangeTests:
+    def changes(self, since=None):
+        return [(change.type, change.name, change.action, change.data) for change in ChangeModel.since(since, 100)]
+
+    def test_orm_writes(self):
+        with self.app_context():
+            store = StoreModel('test')
+            store.save_to_db()
+            item = ItemModel('test', 19.99, 1)
+            item.save_to_db()
+            item.price = 5
+            item.save_to_db()
+            item.save_to_db() # unchanged, nothing to log
+            item.delete_from_db()
+
+            assert self.changes() == [('store', 'test', 'put', {'name': 'test'}),
+                                      ('item', 'test', 'put', {'name': 'test', 'price': 19.99, 'store_id': 1}),
+                                      ('item', 'test', 'put', {'name': 'test', 'price': 5, 'store_id': 1}),
+                                      ('item', 'test', 'delete', None)]
+
+    def test_statement_writes(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            ItemModel.insert('a', 1, 1)
+            ItemModel.insert('a', 2, 1) # exists, nothing written
+            ItemModel.upsert('a', 3, 1)
+            ItemModel.bulk_upsert([{'name': 'a', 'price': 4, 'store_id': 1}, {'name': 'b', 'price': 5, 'store_id': 1}])
+
+            assert self.changes(since=[0, 1]) == [('item', 'a', 'put', {'name': 'a', 'price': 1, 'store_id': 1}),
+                                             ('item', 'a', 'put', {'name': 'a', 'price': 3, 'store_id': 1}),
+                                             ('item', 'a', 'put', {'name': 'a', 'price': 4, 'store_id': 1}),
+                                             ('item', 'b', 'put', {'name': 'b', 'price': 5, 'store_id': 1})]
+            assert ChangeModel.last_position() == [0, 5]
+
+    def test_rolled_back_writes_not_logged(self):
+        with self.app_context():
+            StoreModel('test').save_to_db()
+            with pytest.raises(IntegrityError):
+                StoreModel('test').save_to_db()
+
+            assert len(self.changes()) == 1
+
+    def test_prune(self):
+        with self.app_context():
+            for name in ['a', 'b', 'c']:
+                StoreModel(name).save_to_db()
+            ChangeModel.query.filter(ChangeModel.seq < 3).update({'changed_at': time.time() - 60})
+            ChangeModel.prune(db.session(), time.time() - 30)
+            db.session.commit()
+
+            assert [change.name for change in ChangeModel.since(None, 10)] == ['b', 'c'], "The newest expired change is kept as a marker."
+            assert ChangeModel.is_pruned([0, 1])
+            assert not ChangeModel.is_pruned([0, 2])
@@ -2,7 +2,20 @@ import pytest
 from models.store import StoreModel
 from models.item import ItemModel
 from models.user import UserModel
+from models.change import ChangeModel
 import json
+import gzip
+import time
+import asyncio
+import importlib.util
+from passwords import verify_password
+from conftest import clear_caches
+from app import app as flask_app
+from profiling import profiler, QueryBudgetExceeded
+from replicas import replica_router
+from ratelimit import MemoryBuckets, rate_limiter
+from db import db
+from resources.pagination import encode_cursor
 
 
 @pytest.mark.system
@@ -40,6 +53,48 @@ class ItemTests():
 
                 assert actual_status_code == expected_status_code
 
+    def test_get_item_identity_cached(self):
+        with self.app() as client:
+            with self.app_context():
+                first_resp = client.get('/item/test', headers = {'Authorization': self.access_token})
+                second_resp = client.get('/item/test', headers = {'Authorization': self.access_token})
+                expected_query_count = '1'
+
+                actual_query_count = second_resp.headers['X-Query-Count']
+
+                assert first_resp.headers['X-Query-Count'] == '2'
+                assert actual_query_count == expected_query_count
+
+    def test_get_item_lazy_identity(self, monkeypatch):
+        monkeypatch.setitem(flask_app.config, 'JWT_LAZY_IDENTITY', True)
+        with self.app() as client:
+            with self.app_context():
+                resp = client.get('/item/test', headers = {'Authorization': self.access_token})
+                expected_query_count = '1' # the item, the user is never loaded
+
+                actual_query_count = resp.headers['X-Query-Count']
+
+                assert resp.status_code == 404
+                assert actual_query_count == expected_query_count
+
+    def test_logout_revokes_token(self):
+        with self.app() as client:
+            with self.app_context():
+                logout_resp = client.post('/logout', headers = {'Authorization': self.access_token})
+                resp = client.get('/item/test', headers = {'Authorization': self.access_token})
+
+                assert logout_resp.status_code == 200
+                assert resp.status_code == 401
+
+    def test_login_right_after_logout(self):
+        with self.app() as client:
+            with self.app_context():
+                client.post('/logout', headers = {'Authorization': self.access_token})
+                auth_resp = client.post('/auth', json={'username': 'test', 'password': '1234'})
+                resp = client.get('/item/test', headers = {'Authorization': 'JWT ' + json.loads(auth_resp.data)['access_token']})
+
+                assert resp.status_code == 404, "The new token is valid, even within the second of the logout."
+
     def test_delete_item(self):
         with self.app() as client:
             with self.app_context():
@@ -124,6 +179,32 @@ class ItemTests():
                 assert actual_price_after_update == expected_price_after_update
                 assert actual_payload_after_update == expected_payload_after_update
 
+    def test_put_item_if_match(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                etag = client.post('/item/test', json={'price': 100, 'store_id': 1}).headers['ETag']
+                resp = client.put('/item/test', json={'price': 50, 'store_id': 1}, headers={'If-Match': etag})
+                stale_resp = client.put('/item/test', json={'price': 60, 'store_id': 1}, headers={'If-Match': etag})
+                get_resp = client.get('/item/test', headers={'Authorization': self.access_token})
+
+                assert resp.status_code == 200
+                assert resp.headers['ETag'] != etag
+                assert stale_resp.status_code == 412
+                assert json.loads(get_resp.data) == {'name': 'test', 'price': 50}
+                assert get_resp.headers['ETag'] == resp.headers['ETag']
+
+    def test_put_item_if_match_missing_item(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                resp = client.put('/item/test', json={'price': 50, 'store_id': 1}, headers={'If-Match': '*'})
+                garbage_resp = client.put('/item/test', json={'price': 50, 'store_id': 1}, headers={'If-Match': '"garbage"'})
+
+                assert resp.status_code == 412
+                assert garbage_resp.status_code == 412
+                assert ItemModel.find_by_name('test') is None
+
     def test_item_list(self):
         with self.app() as client:
             with self.app_context():
@@ -131,14 +212,189 @@ class ItemTests():
                 ItemModel('test', 100, 1).save_to_db()
                 resp = client.get('/items')
                 expected_status_code = 200
+                expected_payload = {'items': [{'name': 'test', 'price': 100}], 'next': None}
+
+                actual_status_code = resp.status_code
+                actual_payload = json.loads(resp.data)
+
+                assert actual_status_code == expected_status_code
+                assert actual_payload == expected_payload
+
+
+    def test_item_list_pages(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                for name in ('a', 'b', 'c'):
+                    ItemModel(name, 100, 1).save_to_db()
+                first_page = json.loads(client.get('/items?limit=2').data)
+                second_page = json.loads(client.get('/items?limit=2&after={}'.format(first_page['next'])).data)
+
+                assert [item['name'] for item in first_page['items']] == ['a', 'b']
+                assert [item['name'] for item in second_page['items']] == ['c']
+                assert second_page['next'] is None
+
+    def test_item_list_all(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                ItemModel('test', 100, 1).save_to_db()
+                resp = client.get('/items?all=true')
                 expected_payload = {'items': [{'name': 'test', 'price': 100}]}
 
+                actual_payload = json.loads(resp.data)
+
+                assert actual_payload == expected_payload
+
+    def test_item_search(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                StoreModel('other').save_to_db()
+                for name, price, store_id in (('apple', 1, 1), ('apricot', 5, 1), ('banana', 3, 1), ('ap%', 2, 2), ('apple_pie', 9, 2)):
+                    ItemModel(name, price, store_id).save_to_db()
+
+                def names(query):
+                    return [item['name'] for item in json.loads(client.get('/items?' + query).data)['items']]
+
+                assert names('prefix=ap') == ['apple', 'apricot', 'ap%', 'apple_pie']
+                assert names('prefix=ap%25') == ['ap%']
+                assert names('min_price=2&max_price=5') == ['apricot', 'banana', 'ap%']
+                assert names('store_id=2') == ['ap%', 'apple_pie']
+                assert names('prefix=ap&store_id=1&sort=-price') == ['apricot', 'apple']
+                assert names('sort=name&all=true') == ['ap%', 'apple', 'apple_pie', 'apricot', 'banana']
+
+    def test_item_search_sorted_pages(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                for name, price in (('a', 3), ('b', 1), ('c', 3), ('d', 2), ('e', 3)):
+                    ItemModel(name, price, 1).save_to_db()
+                pages = []
+                cursor = ''
+                while cursor is not None:
+                    page = json.loads(client.get('/items?sort=-price&limit=2' + cursor).data)
+                    pages.append([item['name'] for item in page['items']])
+                    cursor = page['next'] and '&after=' + page['next']
+
+                assert pages == [['e', 'c'], ['a', 'd'], ['b']]
+
+    def test_item_search_invalid_sort(self):
+        with self.app() as client:
+            with self.app_context():
+                resp = client.get('/items?sort=color')
+                expected_status_code = 400
+
+                actual_status_code = resp.status_code
+
+                assert actual_status_code == expected_status_code
+
+    def test_item_list_invalid_cursor(self):
+        with self.app() as client:
+            with self.app_context():
+                resp = client.get('/items?after=garbage')
+                expected_status_code = 400
+
+                actual_status_code = resp.status_code
+
+                assert actual_status_code == expected_status_code
+                assert client.get('/items?after=' + encode_cursor(['x'])).status_code == 400
+                assert client.get('/items?sort=price&after=' + encode_cursor([True, 1])).status_code == 400
+                assert client.get('/items?sort=price&after=' + encode_cursor([1.5, 1])).status_code == 200
+
+    def test_bulk_put_items(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                ItemModel('test', 100, 1).save_to_db()
+                resp = client.put('/items?chunk_size=1', json=[{'name': 'test', 'price': 50, 'store_id': 1},
+                                                               {'name': 'test2', 'price': 10, 'store_id': 1},
+                                                               {'name': 'test2', 'price': 20, 'store_id': 1},
+                                                               {'name': 'test3', 'store_id': 1}])
+                expected_status_code = 200
+                expected_payload = {'items': [{'name': 'test', 'status': 'updated'},
+                                              {'name': 'test2', 'status': 'created'},
+                                              {'name': 'test2', 'status': 'error', 'message': 'Duplicated item name.'},
+                                              {'name': 'test3', 'status': 'error', 'message': 'This field cannot be left blank!'}]}
+
                 actual_status_code = resp.status_code
                 actual_payload = json.loads(resp.data)
 
                 assert actual_status_code == expected_status_code
                 assert actual_payload == expected_payload
+                assert ItemModel.find_by_name('test').price == 50
+                assert ItemModel.find_by_name('test2').price == 10
 
+    def test_bulk_put_items_not_a_list(self):
+        with self.app() as client:
+            with self.app_context():
+                resp = client.put('/items', json={'name': 'test', 'price': 50, 'store_id': 1})
+                expected_status_code = 400
+
+                actual_status_code = resp.status_code
+
+                assert actual_status_code == expected_status_code
+
+    def test_item_export(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                ItemModel('test', 100, 1).save_to_db()
+                ItemModel('test2', 50, 1).save_to_db()
+                resp = client.get('/items/export')
+                expected_status_code = 200
+                expected_lines = [{'name': 'test', 'price': 100}, {'name': 'test2', 'price': 50}]
+
+                actual_status_code = resp.status_code
+                actual_lines = [json.loads(line) for line in resp.data.decode().splitlines()]
+
+                assert actual_status_code == expected_status_code
+                assert resp.mimetype == 'application/x-ndjson'
+                assert actual_lines == expected_lines
+
+    def test_item_list_not_modified(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                ItemModel('test', 100, 1).save_to_db()
+                etag = client.get('/items').headers['ETag']
+                resp = client.get('/items', headers={'If-None-Match': etag})
+
+                assert resp.status_code == 304
+                assert resp.data == b''
+                assert resp.headers['X-Query-Count'] == '1', "Only the catalog version is read."
+                assert client.get('/items/export', headers={'If-None-Match': etag}).status_code == 304
+
+                client.put('/item/test', json={'price': 50, 'store_id': 1})
+                resp = client.get('/items', headers={'If-None-Match': etag})
+                assert resp.status_code == 200
+                assert json.loads(resp.data)['items'] == [{'name': 'test', 'price': 50}]
+
+    def test_item_list_compressed(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                ItemModel.bulk_upsert([{'name': 'item{}'.format(number), 'price': number, 'store_id': 1} for number in range(100)])
+                resp = client.get('/items?all=true', headers={'Accept-Encoding': 'gzip'})
+                plain = client.get('/items?all=true')
+
+                assert resp.headers['Content-Encoding'] == 'gzip'
+                assert 'Accept-Encoding' in resp.headers['Vary']
+                assert gzip.decompress(resp.data) == plain.data
+                assert len(resp.data) < len(plain.data) / 3
+                assert resp.headers['ETag'] == 'W/' + plain.headers['ETag']
+                assert client.get('/items?all=true', headers={'If-None-Match': resp.headers['ETag']}).status_code == 304
+                assert 'Content-Encoding' not in client.get('/store/test?items=count', headers={'Accept-Encoding': 'gzip'}).headers, "Small responses aren't compressed."
+
+    def test_item_export_compressed(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                ItemModel('test', 100, 1).save_to_db()
+                resp = client.get('/items/export', headers={'Accept-Encoding': 'gzip'})
+
+                assert resp.headers['Content-Encoding'] == 'gzip'
+                assert gzip.decompress(resp.data) == b'{"name":"test","price":100.0}\n'
 
 @pytest.mark.system
 @pytest.mark.usefixtures("setup_app", "setup_tests")
@@ -199,6 +455,98 @@ class StoreTests():
                 assert actual_status_code == expected_status_code
                 assert actual_payload == expected_payload
 
+    def test_find_store_not_modified(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                etag = client.get('/store/test').headers['ETag']
+                resp = client.get('/store/test', headers={'If-None-Match': etag})
+                expected_status_code = 304
+
+                actual_status_code = resp.status_code
+
+                assert actual_status_code == expected_status_code
+                assert resp.data == b''
+
+    def test_find_store_cache_invalidated(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                etag = client.get('/store/test').headers['ETag']
+                ItemModel('test name', 100, 1).save_to_db()
+                resp = client.get('/store/test', headers={'If-None-Match': etag})
+                expected_status_code = 200
+                expected_payload = {'name': 'test', 'items': [{'name': 'test name', 'price': 100}]}
+
+                actual_status_code = resp.status_code
+                actual_payload = json.loads(resp.data)
+
+                assert actual_status_code == expected_status_code
+                assert actual_payload == expected_payload
+
+    def test_find_store_items_none_and_count(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                ItemModel('test name', 100, 1).save_to_db()
+                client.get('/store/test?items=count')
+                ItemModel('test name2', 50, 1).save_to_db() # must invalidate the cached count
+                none_resp = client.get('/store/test?items=none')
+                count_resp = client.get('/store/test?items=count')
+
+                assert json.loads(none_resp.data) == {'name': 'test'}
+                assert json.loads(count_resp.data) == {'name': 'test', 'item_count': 2}
+                assert client.get('/store/missing?items=count').status_code == 404
+                assert client.get('/store/test?items=some').status_code == 400
+
+    def test_find_store_items_page(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                StoreModel('other').save_to_db()
+                for name, store_id in (('a', 1), ('b', 2), ('c', 1), ('d', 1)):
+                    ItemModel(name, 100, store_id).save_to_db()
+                first_page = json.loads(client.get('/store/test?items=page&limit=2').data)
+                second_page = json.loads(client.get('/store/test/items?limit=2&after={}'.format(first_page['next'])).data)
+
+                assert first_page['name'] == 'test'
+                assert [item['name'] for item in first_page['items']] == ['a', 'c']
+                assert second_page == {'items': [{'name': 'd', 'price': 100}], 'next': None}
+                assert client.get('/store/missing/items').status_code == 404
+
+    def test_store_summary(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                ItemModel('test name', 100, 1).save_to_db()
+                client.get('/store/test/summary')
+                ItemModel('test name2', 50, 1).save_to_db() # must invalidate the cached summary
+                resp = client.get('/store/test/summary')
+                expected_status_code = 200
+                expected_payload = {'name': 'test', 'item_count': 2, 'min_price': 50, 'max_price': 100, 'avg_price': 75}
+
+                actual_status_code = resp.status_code
+                actual_payload = json.loads(resp.data)
+
+                assert actual_status_code == expected_status_code
+                assert actual_payload == expected_payload
+                assert client.get('/store/missing/summary').status_code == 404
+
+    def test_store_summary_list(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                client.get('/stores/summary')
+                StoreModel('test2').save_to_db()
+                resp = client.get('/stores/summary')
+                expected_payload = {'stores': [{'name': 'test', 'item_count': 0, 'min_price': None, 'max_price': None, 'avg_price': None},
+                                               {'name': 'test2', 'item_count': 0, 'min_price': None, 'max_price': None, 'avg_price': None}]}
+
+                actual_payload = json.loads(resp.data)
+
+                assert actual_payload == expected_payload
+                assert resp.headers['X-Query-Count'] == '1'
+
     def test_store_not_found(self):
         with self.app() as client:
             with self.app_context():
@@ -233,7 +581,7 @@ class StoreTests():
                 StoreModel('test').save_to_db()
                 resp = client.get('/stores')
                 expected_status_code = 200
-                expected_payload = {'stores': [{'name': 'test', 'items': []}]}
+                expected_payload = {'stores': [{'name': 'test', 'items': []}], 'next': None}
 
                 actual_status_code = resp.status_code
                 actual_payload = json.loads(resp.data)
@@ -248,7 +596,7 @@ class StoreTests():
                 ItemModel('test name', 100, 1).save_to_db()
                 resp = client.get('/stores')
                 expected_status_code = 200
-                expected_payload = {'stores': [{'name': 'test', 'items': [{'name': 'test name', 'price': 100}]}]}
+                expected_payload = {'stores': [{'name': 'test', 'items': [{'name': 'test name', 'price': 100}]}], 'next': None}
 
                 actual_status_code = resp.status_code
                 actual_payload = json.loads(resp.data)
@@ -256,6 +604,325 @@ class StoreTests():
                 assert actual_status_code == expected_status_code
                 assert actual_payload == expected_payload
 
+    def test_store_list_pages(self):
+        with self.app() as client:
+            with self.app_context():
+                for name in ('a', 'b', 'c'):
+                    StoreModel(name).save_to_db()
+                ItemModel('test name', 100, 3).save_to_db()
+                first_page = json.loads(client.get('/stores?limit=2').data)
+                second_page = json.loads(client.get('/stores?limit=2&after={}'.format(first_page['next'])).data)
+                expected_second_page = {'stores': [{'name': 'c', 'items': [{'name': 'test name', 'price': 100}]}], 'next': None}
+
+                assert [store['name'] for store in first_page['stores']] == ['a', 'b']
+                assert second_page == expected_second_page
+
+    def test_store_list_not_modified(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                etag = client.get('/stores').headers['ETag']
+                resp = client.get('/stores', headers={'If-None-Match': etag})
+
+                assert resp.status_code == 304
+                assert resp.headers['X-Query-Count'] == '1'
+
+                client.post('/store/test2')
+                assert client.get('/stores', headers={'If-None-Match': etag}).status_code == 200
+
+    def test_store_list_query_count_constant(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                ItemModel('test name', 100, 1).save_to_db()
+                expected_query_count = client.get('/stores').headers['X-Query-Count']
+
+                StoreModel('test2').save_to_db()
+                StoreModel('test3').save_to_db()
+                ItemModel('test name2', 10, 2).save_to_db()
+                ItemModel('test name3', 20, 3).save_to_db()
+                resp = client.get('/stores')
+                actual_query_count = resp.headers['X-Query-Count']
+
+                assert actual_query_count == expected_query_count
+                assert len(json.loads(resp.data)['stores']) == 3
+
+@pytest.mark.system
+@pytest.mark.usefixtures("setup_app", "setup_tests")
+class ChangeTests():
+    def test_changes(self):
+        with self.app() as client:
+            with self.app_context():
+                client.post('/store/test')
+                client.post('/item/a', json={'price': 1, 'store_id': 1})
+                client.put('/items', json=[{'name': 'a', 'price': 2, 'store_id': 1}, {'name': 'b', 'price': 3, 'store_id': 1}])
+                client.delete('/item/b')
+                first_page = json.loads(client.get('/changes?limit=2').data)
+                second_page = json.loads(client.get('/changes?since={}'.format(first_page['next'])).data)
+                expected_second_page = {'changes': [{'seq': 3, 'type': 'item', 'name': 'a', 'action': 'put', 'data': {'name': 'a', 'price': 2, 'store_id': 1}},
+                                                    {'seq': 4, 'type': 'item', 'name': 'b', 'action': 'put', 'data': {'name': 'b', 'price': 3, 'store_id': 1}},
+                                                    {'seq': 5, 'type': 'item', 'name': 'b', 'action': 'delete', 'data': None}],
+                                        'next': encode_cursor([0, 5]), 'last': encode_cursor([0, 5])}
+
+                assert [change['name'] for change in first_page['changes']] == ['test', 'a']
+                assert first_page['next'] == encode_cursor([0, 2])
+                assert second_page == expected_second_page
+
+    def test_no_changes(self):
+        with self.app() as client:
+            with self.app_context():
+                client.post('/store/test')
+                start = time.monotonic()
+                last = json.loads(client.get('/changes').data)['last']
+                resp = client.get('/changes?since={}&wait=0.2'.format(last))
+
+                assert json.loads(resp.data) == {'changes': [], 'next': last, 'last': last}
+                assert time.monotonic() - start >= 0.2, "A long poll waits for changes."
+                assert client.get('/changes?since=' + encode_cursor([0, True])).status_code == 400
+                assert client.get('/changes?since=').status_code == 400
+
+    def test_wait_bounded(self):
+        with self.app() as client:
+            with self.app_context():
+                for wait in ['nan', 'inf', '-1', '31']:
+                    assert client.get('/changes?wait=' + wait).status_code == 400, "A long poll can't outlast MAX_WAIT."
+
+    def test_pruned_changes(self):
+        with self.app() as client:
+            with self.app_context():
+                for name in ['a', 'b', 'c']:
+                    client.post('/store/' + name)
+                ChangeModel.query.filter(ChangeModel.seq < 3).update({'changed_at': time.time() - 60})
+                ChangeModel.prune(db.session(), time.time() - 30)
+                db.session.commit()
+
+                assert client.get('/changes?since=' + encode_cursor([0, 1])).status_code == 410
+                assert [change['name'] for change in json.loads(client.get('/changes?since=' + encode_cursor([0, 2])).data)['changes']] == ['c']
+
+
+@pytest.mark.system
+@pytest.mark.usefixtures("setup_app", "setup_tests")
+class ReplicaTests():
+    @pytest.fixture(autouse=True)
+    def setup_replicas(self, tmp_path):
+        replica_router.configure(['sqlite:///{}'.format(tmp_path / 'replica1.db'), 'sqlite:///{}'.format(tmp_path / 'replica2.db')])
+        for number, engine in enumerate(replica_router.engines, 1): # stand-ins for replicated databases, each with its own store
+            db.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.execute(StoreModel.__table__.insert().values(name='replica{}'.format(number)))
+        yield
+        replica_router.configure([])
+
+    def store_names(self, client):
+        return [store['name'] for store in json.loads(client.get('/stores').data)['stores']]
+
+    def test_reads_round_robin(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('primary').save_to_db()
+
+                assert self.store_names(client) == ['replica1']
+                assert self.store_names(client) == ['replica2']
+                assert self.store_names(client) == ['replica1']
+
+    def test_read_your_writes(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('primary').save_to_db()
+                client.post('/store/test')
+
+                assert self.store_names(client) == ['primary', 'test']
+
+    def test_read_your_writes_across_workers(self):
+        with self.app() as client:
+            with self.app_context():
+                client.post('/store/test')
+                replica_router.sticky.clear() # the next request is served by another worker
+
+                assert self.store_names(client) == ['test'], "The cookie sends the client's reads to the primary."
+
+    def test_catalog_etag_follows_the_data(self):
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('primary').save_to_db() # the replicas don't have it
+                replica_etag = client.get('/stores').headers['ETag']
+                client.post('/store/test', headers={'Authorization': 'writer'})
+                resp = client.get('/stores', headers={'Authorization': 'writer', 'If-None-Match': replica_etag})
+
+                assert resp.status_code == 200, "The primary has changes the replica's version doesn't cover."
+                assert self.app().get('/stores', headers={'If-None-Match': replica_etag}).status_code == 304, "Another client reads the replica."
+
+    def test_replica_reads_not_cached(self, monkeypatch):
+        monkeypatch.setattr(replica_router, 'choose', lambda: replica_router.engines[0])
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('replica1').save_to_db()
+                client.post('/item/test', json={'price': 100, 'store_id': 1}, headers={'Authorization': 'writer'})
+                lagging = json.loads(self.app().get('/store/replica1').data) # another client, the replica doesn't have the item yet
+                resp = client.get('/store/replica1', headers={'Authorization': 'writer'})
+
+                assert lagging == {'name': 'replica1', 'items': []}
+                assert json.loads(resp.data) == {'name': 'replica1', 'items': [{'name': 'test', 'price': 100}]}
+
+    def test_least_loaded(self):
+        replica_router.selection = 'least_loaded'
+        busy, idle = replica_router.engines
+        replica_router.in_use[busy] = 3
+
+        assert replica_router.choose() is idle
+
+    def test_unhealthy_replica(self):
+        replica_router.configure(['sqlite:////nonexistent/replica.db'])
+        replica_router.down_until[replica_router.engines[0]] = 0 # its retry delay is over, so it gets pinged
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('primary').save_to_db()
+
+                assert replica_router.choose() is None
+                assert self.store_names(client) == ['primary']
+
+
+@pytest.mark.system
+@pytest.mark.usefixtures("setup_app", "setup_tests")
+class RateLimitTests():
+    @pytest.fixture(autouse=True)
+    def setup_limiter(self, monkeypatch):
+        monkeypatch.setattr(rate_limiter, 'backend', MemoryBuckets())
+        monkeypatch.setattr(rate_limiter, 'limits', {'POST store': (0.5, 2)})
+
+    def test_rate_limited(self):
+        with self.app() as client:
+            with self.app_context():
+                statuses = [client.post('/store/test{}'.format(number)).status_code for number in range(3)]
+                resp = client.post('/store/test3')
+
+                assert statuses == [201, 201, 429]
+                assert resp.status_code == 429
+                assert resp.headers['Retry-After'] == '2'
+                assert json.loads(resp.data) == {'message': 'Too many requests, please slow down.'}
+                assert client.get('/stores').status_code == 200, "Other routes have their own limits."
+
+    def test_login_rate_limited(self, monkeypatch):
+        monkeypatch.setattr(rate_limiter, 'limits', {'POST auth': (0.01, 1)})
+        with self.app() as client:
+            with self.app_context():
+                client.post('/register', json={'username': 'test', 'password': '1234'})
+                credentials = {'username': 'test', 'password': '1234'}
+
+                assert client.post('/auth', json=credentials).status_code == 200
+                assert client.post('/auth', json=credentials).status_code == 429
+
+    def test_clients_limited_apart(self):
+        with self.app() as client:
+            with self.app_context():
+                client.post('/store/a')
+                client.post('/store/b')
+
+                assert client.post('/store/c', environ_base={'REMOTE_ADDR': '10.0.0.2'}).status_code == 201
+
+    def test_concurrency_cap(self, monkeypatch):
+        monkeypatch.setattr(rate_limiter, 'max_concurrent', 1)
+        with self.app() as client:
+            with self.app_context():
+                monkeypatch.setattr(rate_limiter, 'in_flight', 1) # another request in progress
+                resp = client.get('/stores')
+
+                assert resp.status_code == 503
+                assert resp.headers['Retry-After'] == '1'
+                assert client.get('/metrics').status_code == 200, "Monitoring isn't limited."
+
+                rate_limiter.in_flight = 0
+                assert client.get('/stores').status_code == 200
+                assert rate_limiter.in_flight == 0, "Finished requests leave."
+
+
+@pytest.mark.system
+@pytest.mark.usefixtures("setup_app", "setup_tests")
+class MetricsTests():
+    def test_pool_metrics(self):
+        with self.app() as client:
+            with self.app_context():
+                resp = client.get('/metrics/pool')
+                expected_status_code = 200
+
+                actual_status_code = resp.status_code
+                actual_payload = json.loads(resp.data)
+
+                assert actual_status_code == expected_status_code
+                assert actual_payload['checkouts'] >= 1
+                assert 'status' in actual_payload['pool']
+
+    def test_prometheus_metrics(self):
+        with self.app() as client:
+            with self.app_context():
+                client.get('/item/test')
+                client.get('/store/test')
+                resp = client.get('/metrics')
+                expected_status_code = 200
+
+                actual_status_code = resp.status_code
+                actual_text = resp.data.decode()
+
+                assert actual_status_code == expected_status_code
+                assert resp.mimetype == 'text/plain'
+                assert 'http_requests_total{endpoint="item",method="GET",status="401"}' in actual_text
+                assert 'http_requests_total{endpoint="store",method="GET",status="404"}' in actual_text
+                assert 'http_request_duration_seconds_bucket{endpoint="store",method="GET",le="+Inf"}' in actual_text
+
+    def test_profile_requests(self, monkeypatch):
+        monkeypatch.setitem(flask_app.config, 'PROFILE_REQUESTS', True)
+        profiler.reset()
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                resp = client.get('/stores')
+                profile = json.loads(client.get('/metrics/profile').data)
+
+                assert resp.headers['Server-Timing'].startswith('db;dur=')
+                assert 'desc="3 queries"' in resp.headers['Server-Timing']
+                assert profile['GET storelist']['queries']['count'] == 1
+                assert profile['GET storelist']['slowest_query']['statement'].startswith('SELECT')
+
+    def test_profile_streamed_response(self, monkeypatch):
+        monkeypatch.setitem(flask_app.config, 'PROFILE_REQUESTS', True)
+        profiler.reset()
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+                ItemModel('test', 100, 1).save_to_db()
+                resp = client.get('/items/export')
+                resp.close()
+                profile = json.loads(client.get('/metrics/profile').data)
+
+                assert 'X-Query-Count' not in resp.headers, "The headers are sent before the body runs its queries."
+                assert profile['GET itemexport']['queries']['count'] == 1
+                assert profile['GET itemexport']['queries']['sum'] >= 1
+
+    def test_query_budget_strict(self, monkeypatch):
+        monkeypatch.setitem(flask_app.config, 'PROFILE_REQUESTS', True)
+        monkeypatch.setitem(flask_app.config, 'QUERY_BUDGET_STRICT', True)
+        monkeypatch.setitem(flask_app.config, 'QUERY_BUDGETS', {'GET storelist': 1})
+        with self.app() as client:
+            with self.app_context():
+                StoreModel('test').save_to_db()
+
+                with pytest.raises(QueryBudgetExceeded):
+                    client.get('/stores')
+
+    def test_query_budget_block(self):
+        with self.app() as client:
+            with self.app_context():
+                for name in ('a', 'b', 'c'):
+                    StoreModel(name).save_to_db()
+                    ItemModel(name, 100, 1).save_to_db()
+
+                with profiler.query_budget(3): # the catalog version, the stores and their items
+                    client.get('/stores')
+                with pytest.raises(QueryBudgetExceeded):
+                    with profiler.query_budget(2):
+                        client.get('/stores')
+
+
 @pytest.mark.system
 @pytest.mark.usefixtures("setup_app", "setup_tests")
 class UserTests():
@@ -272,6 +939,7 @@ class UserTests():
                 assert actual_status_code == expected_status_code
                 assert actual_message == expected_message
                 assert UserModel.find_by_username('test')            
+                assert UserModel.find_by_username('test').password != '1234', "The password must not be stored in plaintext."
 
     def test_register_and_login(self):
         with self.app() as client:
@@ -286,6 +954,35 @@ class UserTests():
 
                 assert expected_key_of_response in actual_key_of_response
 
+    def test_login_rehashes_plaintext_password(self):
+        with self.app() as client:
+            with self.app_context():
+                UserModel('test', '1234').save_to_db()
+                auth_resp = client.post('/auth',
+                                        json={'username': 'test', 'password': '1234'},
+                                        headers = {'Content-Type': 'application/json'})
+                expected_status_code = 200
+
+                actual_status_code = auth_resp.status_code
+                actual_password = UserModel.find_by_username('test').password
+
+                assert actual_status_code == expected_status_code
+                assert actual_password != '1234'
+                assert verify_password('1234', actual_password)
+
+    def test_login_wrong_password(self):
+        with self.app() as client:
+            with self.app_context():
+                client.post('/register', json={'username': 'test', 'password': '1234'})
+                auth_resp = client.post('/auth',
+                                        json={'username': 'test', 'password': '12345'},
+                                        headers = {'Content-Type': 'application/json'})
+                expected_status_code = 401
+
+                actual_status_code = auth_resp.status_code
+
+                assert actual_status_code == expected_status_code
+
     def test_register_duplicate_user(self):
         with self.app() as client:
             with self.app_context():
@@ -299,3 +996,103 @@ class UserTests():
 
                 assert actual_status_code == expected_status_code
                 assert actual_message == expected_message
+
+
+def call_asgi(asgi_app, method, path, payload=None, headers=None, response_headers=None):
+    """
+    Sends one request straight to an ASGI application.
+    :param response_headers: A dictionary to fill with the headers of the response.
+    :return: A tuple (status code, decoded JSON body).
+    """
+    scope = {'type': 'http', 'method': method, 'path': path.split('?')[0],
+             'query_string': path.partition('?')[2].encode(),
+             'headers': [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()]}
+    body = json.dumps(payload).encode() if payload is not None else b''
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+    if response_headers is not None:
+        response_headers.update((key.decode(), value.decode()) for key, value in messages[0]['headers'])
+    return messages[0]['status'], json.loads(messages[1]['body'])
+
+
+@pytest.mark.system
+@pytest.mark.skipif(importlib.util.find_spec('aiosqlite') is None, reason="The async mode needs aiosqlite")
+class AsgiTests():
+    @pytest.fixture(autouse=True)
+    def setup_asgi(self, tmp_path):
+        from asgi import AsyncApi
+        self.asgi = AsyncApi('sqlite:///{}'.format(tmp_path / 'test.db'))
+        asyncio.run(self.asgi.create_tables())
+        yield
+        asyncio.run(self.asgi.engine.dispose())
+        clear_caches()
+
+    def test_store_and_items(self):
+        call_asgi(self.asgi, 'POST', '/store/test')
+        status_code, payload = call_asgi(self.asgi, 'POST', '/item/test', {'price': 100, 'store_id': 1})
+
+        assert status_code == 201
+        assert payload == {'name': 'test', 'price': 100}
+        assert call_asgi(self.asgi, 'GET', '/store/test') == (200, {'name': 'test', 'items': [{'name': 'test', 'price': 100}]})
+        assert call_asgi(self.asgi, 'GET', '/stores') == (200, {'stores': [{'name': 'test', 'items': [{'name': 'test', 'price': 100}]}], 'next': None})
+        assert call_asgi(self.asgi, 'GET', '/items?limit=1') == (200, {'items': [{'name': 'test', 'price': 100}], 'next': None})
+
+    def test_item_writes(self):
+        call_asgi(self.asgi, 'POST', '/store/test')
+        headers = {}
+        assert call_asgi(self.asgi, 'POST', '/item/test', {'price': 100, 'store_id': 1}, response_headers=headers)[0] == 201
+        assert call_asgi(self.asgi, 'POST', '/item/test', {'price': 100, 'store_id': 1}) == (400, {'message': "An item with name 'test' already exists."})
+
+        etag = headers['etag']
+        assert call_asgi(self.asgi, 'PUT', '/item/test', {'price': 50, 'store_id': 1}, {'If-Match': etag}, headers) == (200, {'name': 'test', 'price': 50})
+        assert headers['etag'] != etag
+        assert call_asgi(self.asgi, 'PUT', '/item/test', {'price': 60, 'store_id': 1}, {'If-Match': etag})[0] == 412, "Somebody changed it since."
+        assert call_asgi(self.asgi, 'PUT', '/item/other', {'price': 60, 'store_id': 1}, {'If-Match': '*'})[0] == 412
+        assert call_asgi(self.asgi, 'PUT', '/item/other', {'price': 60, 'store_id': 1})[0] == 200
+        assert call_asgi(self.asgi, 'GET', '/items') == (200, {'items': [{'name': 'test', 'price': 50}, {'name': 'other', 'price': 60}], 'next': None})
+
+    def test_item_bulk_write_and_delete(self):
+        call_asgi(self.asgi, 'POST', '/store/test')
+        call_asgi(self.asgi, 'POST', '/item/test', {'price': 100, 'store_id': 1})
+        status_code, payload = call_asgi(self.asgi, 'PUT', '/items', [{'name': 'test', 'price': 50, 'store_id': 1},
+                                                                        {'name': 'other', 'price': 60, 'store_id': 1}])
+
+        assert status_code == 200
+        assert payload == {'items': [{'name': 'test', 'status': 'updated'}, {'name': 'other', 'status': 'created'}]}
+        assert call_asgi(self.asgi, 'DELETE', '/item/test') == (200, {'message': 'Item deleted'})
+        assert call_asgi(self.asgi, 'DELETE', '/item/test') == (200, {'message': 'Item deleted'})
+        assert call_asgi(self.asgi, 'GET', '/store/test') == (200, {'name': 'test', 'items': [{'name': 'other', 'price': 60}]})
+
+    def test_item_search(self):
+        call_asgi(self.asgi, 'POST', '/store/test')
+        for name, price in (('apple', 3), ('apricot', 1), ('banana', 2)):
+            call_asgi(self.asgi, 'POST', '/item/' + name, {'price': price, 'store_id': 1})
+        status_code, first_page = call_asgi(self.asgi, 'GET', '/items?prefix=ap&sort=price&limit=1')
+        second_page = call_asgi(self.asgi, 'GET', '/items?prefix=ap&sort=price&limit=1&after=' + first_page['next'])[1]
+
+        assert status_code == 200
+        assert first_page['items'] == [{'name': 'apricot', 'price': 1}]
+        assert second_page == {'items': [{'name': 'apple', 'price': 3}], 'next': None}
+        assert call_asgi(self.asgi, 'GET', '/items?sort=color')[0] == 400
+
+    def test_get_item_needs_auth(self):
+        call_asgi(self.asgi, 'POST', '/store/test')
+        call_asgi(self.asgi, 'POST', '/item/test', {'price': 100, 'store_id': 1})
+        call_asgi(self.asgi, 'POST', '/register', {'username': 'test', 'password': '1234'})
+        status_code, payload = call_asgi(self.asgi, 'POST', '/auth', {'username': 'test', 'password': '1234'})
+        headers = {'Authorization': 'JWT {}'.format(payload['access_token'])}
+
+        assert status_code == 200
+        assert call_asgi(self.asgi, 'GET', '/item/test')[0] == 401
+        assert call_asgi(self.asgi, 'GET', '/item/test', headers=headers) == (200, {'name': 'test', 'price': 100})
+
+    def test_not_found(self):
+        assert call_asgi(self.asgi, 'GET', '/store/test') == (404, {'message': 'Store not found'})
+        assert call_asgi(self.asgi, 'GET', '/nothing')[0] == 404
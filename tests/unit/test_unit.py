@@ -1,7 +1,29 @@
 from models.user import UserModel
 from models.item import ItemModel
 from models.store import StoreModel
+from cache import TTLCache, RedisCache, ResponseCache
+from compression import Compressor
+from models.change import ChangeFeed
+from passwords import hash_password, needs_rehash, verify_password
+from metrics import Histogram, InstrumentedQueuePool, RequestMetrics
+from db import engine_options
+from serializers import BACKENDS, get_backend
+import security
+from security import init_revocations, is_revoked, revoke_tokens, revoked_tokens
+from ratelimit import MemoryBuckets, SharedBuckets, parse_limits, take_token
+from resources.item import search_parser
+from resources.pagination import parse_query
+from werkzeug.exceptions import BadRequest
+from flask import Flask
+from tests.benchmark.common import percentile
+from tests.benchmark.compare import compare
 import pytest
+import json
+import importlib.util
+from datetime import timedelta
+import gzip
+import threading
+import time
 
 @pytest.mark.unit
 class UserTests:
@@ -55,4 +77,353 @@ class StoreTests:
         actual_name = store.name
 
         assert actual_name == expected_name, 'The name of the store after creation does not equal to the constructor argument.'
-    
\ No newline at end of file
+    
+
+
+@pytest.mark.unit
+class TTLCacheTests:
+    def test_get_set(self):
+        cache = TTLCache()
+        cache.set('key', 'value')
+
+        assert cache.get('key') == 'value'
+        assert cache.get('missing') is None
+        assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+    def test_expiry(self):
+        now = [0]
+        cache = TTLCache(ttl=10, timer=lambda: now[0])
+        cache.set('key', 'value')
+        now[0] = 11
+
+        assert cache.get('key') is None, "The entry should have expired."
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert cache.get('b') is None, "The least recently used entry should have been evicted."
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    def test_delete(self):
+        cache = TTLCache()
+        cache.set('key', 'value')
+        cache.delete('key')
+
+        assert cache.get('key') is None
+
+    def test_add_never_evicts_live_entries(self):
+        now = [0]
+        cache = TTLCache(maxsize=1, ttl=10, timer=lambda: now[0])
+
+        assert cache.add('a', 1)
+        assert not cache.add('b', 2)
+        now[0] = 10
+        assert cache.add('b', 2), "Expired entries make room."
+        assert cache.get('a') is None
+
+
+class FakeRedis:
+    """
+    Stands in for a Redis client, only what RedisCache uses.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def scan_iter(self, pattern):
+        return [key for key in list(self.data) if key.startswith(pattern.rstrip('*'))]
+
+
+@pytest.mark.unit
+class ResponseCacheTests:
+    def test_set_returns_etag(self):
+        cache = ResponseCache(TTLCache())
+
+        payload, etag = cache.set('item:test', {'name': 'test', 'price': 19.99})
+
+        assert cache.get('item:test') == (payload, etag)
+        assert etag == ResponseCache(TTLCache()).set('other', {'price': 19.99, 'name': 'test'})[1], "The ETag must only depend on the payload."
+
+    def test_invalidate(self):
+        cache = ResponseCache(TTLCache())
+        cache.set('item:test', {'name': 'test', 'price': 19.99})
+        cache.invalidate('item:test', 'store:test')
+
+        assert cache.get('item:test') is None
+
+    def test_redis_backend(self):
+        cache = ResponseCache(RedisCache(FakeRedis()))
+        entry = cache.set('store:test', {'name': 'test', 'items': []})
+
+        assert cache.get('store:test') == entry
+        cache.clear()
+        assert cache.get('store:test') is None
+
+    def test_stale_fill_dropped(self):
+        cache = ResponseCache(TTLCache())
+        generation = cache.generation('item:test') # then the item is read, and a write invalidates it meanwhile
+        cache.invalidate('item:test')
+        cache.set('item:test', {'name': 'test', 'price': 1}, generation=generation)
+
+        assert cache.get('item:test') is None, "The payload read before the write isn't cached."
+        cache.set('item:test', {'name': 'test', 'price': 2}, generation=cache.generation('item:test'))
+        assert cache.get('item:test')[0] == {'name': 'test', 'price': 2}
+
+
+@pytest.mark.unit
+class PasswordTests:
+    def test_hash_and_verify(self):
+        stored = hash_password('1234', 'pbkdf2_sha256', 1000)
+
+        assert stored.startswith('$pbkdf2_sha256$1000$')
+        assert verify_password('1234', stored)
+        assert not verify_password('12345', stored)
+
+    def test_scrypt(self):
+        stored = hash_password('1234', 'scrypt', 10)
+
+        assert verify_password('1234', stored)
+        assert not verify_password('12345', stored)
+
+    def test_salted(self):
+        assert hash_password('1234', 'pbkdf2_sha256', 1000) != hash_password('1234', 'pbkdf2_sha256', 1000)
+
+    def test_legacy_plaintext(self):
+        assert verify_password('1234', '1234')
+        assert not verify_password('12345', '1234')
+        assert needs_rehash('1234')
+
+    def test_needs_rehash_other_cost(self):
+        assert needs_rehash(hash_password('1234', 'pbkdf2_sha256', 1000))
+        assert not needs_rehash(hash_password('1234'))
+
+
+@pytest.mark.unit
+class HistogramTests:
+    def test_observe(self):
+        histogram = Histogram(buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.observe(value)
+        expected_snapshot = {'buckets': {'0.1': 1, '1': 3, '+Inf': 4}, 'sum': 4.25, 'count': 4}
+
+        actual_snapshot = histogram.snapshot()
+
+        assert actual_snapshot == expected_snapshot
+
+
+@pytest.mark.unit
+class EngineOptionsTests:
+    def test_defaults(self):
+        assert engine_options('sqlite:///data.db', {}) == {}
+        assert engine_options('postgresql://localhost/stores', {}) == {'poolclass': InstrumentedQueuePool}
+
+    def test_from_environment(self):
+        environ = {'DB_POOL_SIZE': '10', 'DB_MAX_OVERFLOW': '5', 'DB_POOL_TIMEOUT': '2.5',
+                   'DB_POOL_RECYCLE': '1800', 'DB_POOL_PRE_PING': 'true'}
+        expected_options = {'pool_size': 10, 'max_overflow': 5, 'pool_timeout': 2.5, 'pool_recycle': 1800,
+                            'pool_pre_ping': True, 'poolclass': InstrumentedQueuePool}
+
+        actual_options = engine_options('postgresql://localhost/stores', environ)
+
+        assert actual_options == expected_options
+
+
+@pytest.mark.unit
+class BenchmarkTests:
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile([], 50) is None
+
+    def test_compare_regressions(self):
+        base = [{'scenario': 'GET /stores', 'throughput_rps': 100, 'p95_ms': 10, 'queries_per_request': 2}]
+        change = [{'scenario': 'GET /stores', 'throughput_rps': 80, 'p95_ms': 10.5, 'queries_per_request': 3}]
+
+        comparisons, regressions = compare(base, change, tolerance=10)
+
+        assert comparisons[0]['throughput_rps']['percent'] == -20
+        assert len(regressions) == 2, "Throughput and query count regressed, p95 is within tolerance."
+
+
+@pytest.mark.unit
+class RequestMetricsTests:
+    def test_render(self):
+        metrics = RequestMetrics()
+        metrics.observe('item', 'GET', 401, 0.002)
+        metrics.observe('item', 'GET', 200, 0.02)
+
+        actual_text = metrics.render()
+
+        assert 'http_requests_total{endpoint="item",method="GET",status="401"} 1' in actual_text
+        assert 'http_request_duration_seconds_bucket{endpoint="item",method="GET",le="0.0025"} 1' in actual_text
+        assert 'http_request_duration_seconds_count{endpoint="item",method="GET"} 2' in actual_text
+
+    def test_multiple_processes(self, tmp_path):
+        other_process = RequestMetrics()
+        other_process.observe('store', 'GET', 404, 0.001)
+        (tmp_path / 'metrics-0.json').write_text(json.dumps(other_process.state()))
+        metrics = RequestMetrics()
+        metrics.multiprocess_dir = str(tmp_path)
+        metrics.observe('store', 'GET', 404, 0.001)
+
+        actual_text = metrics.render()
+
+        assert 'http_requests_total{endpoint="store",method="GET",status="404"} 2' in actual_text
+        assert 'http_request_duration_seconds_count{endpoint="store",method="GET"} 2' in actual_text
+
+
+@pytest.mark.unit
+class SerializerTests:
+    def test_backends_agree(self):
+        payload = {'items': [{'name': 'test', 'price': 19.99}, {'name': 'n\u00e4me', 'price': None}], 'next': None}
+        backends = [BACKENDS[name]() for name in BACKENDS if name == 'json' or importlib.util.find_spec(name)]
+
+        actual_payloads = [json.loads(backend.dumps(payload)) for backend in backends]
+
+        assert all(actual_payload == payload for actual_payload in actual_payloads)
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            get_backend('yaml')
+
+
+@pytest.mark.unit
+class RevocationTests:
+    def test_is_revoked(self):
+        now = int(time.time())
+        revoke_tokens(42)
+
+        assert is_revoked({'identity': 42, 'iat': now - 10}), "Tokens issued before the revocation are refused."
+        assert not is_revoked({'identity': 42, 'iat': now + 10}), "Tokens issued after the revocation are accepted."
+        assert not is_revoked({'identity': 43, 'iat': now - 10}), "Other users' tokens are accepted."
+        revoked_tokens.clear()
+
+    def test_is_revoked_exact_issue_time(self):
+        revoke_tokens(42)
+        revoked_at = revoked_tokens.get(42)
+
+        assert is_revoked({'identity': 42, 'iat': int(revoked_at), 'issued_at': revoked_at - 0.001})
+        assert not is_revoked({'identity': 42, 'iat': int(revoked_at), 'issued_at': revoked_at + 0.001})
+        assert not is_revoked({'identity': 42, 'iat': int(revoked_at)}), "Older tokens issued in the same second get the benefit of the doubt."
+        revoked_tokens.clear()
+
+    def test_revocations_never_evicted(self, monkeypatch):
+        monkeypatch.setattr(revoked_tokens, 'maxsize', 1)
+        assert revoke_tokens(42)
+        assert not revoke_tokens(43), "A full list refuses new revocations instead of forgetting old ones."
+        assert revoke_tokens(42)
+        assert is_revoked({'identity': 42, 'iat': 0})
+        revoked_tokens.clear()
+
+    def test_revocations_outlive_tokens(self, monkeypatch):
+        monkeypatch.setattr(revoked_tokens, 'ttl', revoked_tokens.ttl)
+        app = Flask(__name__)
+        app.config.update(JWT_EXPIRATION_DELTA=timedelta(hours=1), JWT_LEEWAY=timedelta(seconds=10))
+        init_revocations(app)
+
+        assert revoked_tokens.ttl == 3610, "Flask-JWT accepts tokens until they expire, plus the leeway."
+
+    def test_shared_revocations(self, monkeypatch):
+        monkeypatch.setattr(security, 'revoked_tokens', RedisCache(FakeRedis()))
+        revoke_tokens(42)
+
+        assert is_revoked({'identity': 42, 'iat': 0})
+        assert not is_revoked({'identity': 43, 'iat': 0})
+
+
+@pytest.mark.unit
+class RateLimitTests:
+    def test_parse_limits(self):
+        assert parse_limits('GET itemlist=50:100, POST auth=1') == {'GET itemlist': (50.0, 100.0), 'POST auth': (1.0, 1.0)}
+        assert parse_limits('') == {}
+        with pytest.raises(ValueError):
+            parse_limits('POST auth=0')
+        with pytest.raises(ValueError):
+            parse_limits('POST auth=1:0.5')
+
+    def test_take_token(self):
+        assert take_token(2, 0, 1, 2, 0) == (True, 1, 0.0)
+        assert take_token(0.5, 0, 1, 2, 0) == (False, 0.5, 0.5)
+        assert take_token(0, 0, 1, 2, 10) == (True, 1, 0.0), "Buckets refill up to the burst."
+
+    @pytest.mark.parametrize('make_buckets', [
+        lambda tmp_path, timer: MemoryBuckets(timer=timer),
+        lambda tmp_path, timer: SharedBuckets(str(tmp_path / 'buckets'), slots=16, timer=timer),
+    ])
+    def test_buckets(self, tmp_path, make_buckets):
+        now = [0]
+        buckets = make_buckets(tmp_path, lambda: now[0])
+
+        assert [buckets.take('a', 1, 2)[0] for _ in range(3)] == [True, True, False]
+        assert buckets.take('b', 1, 2)[0], "Every key has its own bucket."
+        now[0] = 1
+        assert buckets.take('a', 1, 2) == (True, 0.0)
+
+    def test_shared_buckets_between_processes(self, tmp_path):
+        path = str(tmp_path / 'buckets')
+        SharedBuckets(path, slots=16).take('a', 0.001, 1)
+
+        assert SharedBuckets(path, slots=16).take('a', 0.001, 1)[0] is False, "Another worker sees the same bucket."
+
+
+@pytest.mark.unit
+class CompressorTests:
+    def test_gzip(self):
+        data = json.dumps({'items': [{'name': 'item', 'price': 1.0}] * 100}).encode()
+        compressed = Compressor().compress(data, 'gzip')
+
+        assert gzip.decompress(compressed) == data
+        assert compressed == Compressor().compress(data, 'gzip'), "The same body compresses to the same bytes."
+
+    def test_gzip_stream(self):
+        chunks = [b'{"name":"item","price":1.0}\n'] * 100
+
+        assert gzip.decompress(b''.join(Compressor().compress_stream(chunks))) == b''.join(chunks)
+
+
+@pytest.mark.unit
+class ChangeFeedTests:
+    def test_wait(self):
+        feed = ChangeFeed()
+        seen = feed.seq
+
+        assert not feed.wait(seen, 0.01)
+        threading.Timer(0.01, feed.notify).start()
+        assert feed.wait(seen, 5), "Waiters wake up on a commit with changes."
+        assert feed.wait(seen, 0), "A commit since seen doesn't need waiting for."
+
+
+@pytest.mark.unit
+class ParseQueryTests:
+    def test_parse_query(self):
+        args = parse_query(search_parser, {'limit': '10', 'min_price': '2.5', 'sort': '-price'})
+
+        assert args['limit'] == 10
+        assert args['min_price'] == 2.5
+        assert args['sort'] == '-price'
+        assert args['all'] is False and args['prefix'] is None, "Missing arguments get their default."
+
+    @pytest.mark.parametrize('args, message', [
+        ({'limit': '0'}, {'limit': 'limit must be between 1 and 1000.'}),
+        ({'sort': 'color'}, {'sort': 'sort must be one of id, name or price, optionally prefixed with - for descending order.'}),
+    ])
+    def test_invalid(self, args, message):
+        with pytest.raises(BadRequest) as error:
+            parse_query(search_parser, args)
+
+        assert error.value.data == {'message': message}